@@ -0,0 +1,28 @@
+"""
+端口转发的回归测试，用pytest运行，也可以直接运行
+python -m pytest test_端口转发.py
+"""
+import os
+import socket
+import subprocess
+import sys
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "端口转发.py")
+
+
+def test_workers_port_in_use():
+    """多进程模式下端口被占用时，应该和单进程模式一样报错退出，而不是一直重新启动工作进程"""
+    with socket.socket() as occupied:
+        occupied.bind(("127.0.0.1", 0))
+        occupied.listen()
+        port = occupied.getsockname()[1]
+        for workers in ("1", "2"):
+            result = subprocess.run([sys.executable, SCRIPT, str(port), "127.0.0.1", "1", "--bind-ip", "127.0.0.1",
+                                     "--workers", workers], capture_output=True, text=True, timeout=20)
+            assert result.returncode != 0, result.stderr
+            assert "重新启动" not in result.stderr
+
+
+if __name__ == '__main__':
+    test_workers_port_in_use()
+    print("test_workers_port_in_use ok")
@@ -0,0 +1,353 @@
+"""
+下载器的性能测试，直接运行即可，也可以只运行其中一项
+python Benchmark.py [writer|http2|sync|matrix]
+matrix在本地的FakeServer上按不同参数组合下载，输出速度、CPU时间和峰值内存；
+设置环境变量BENCHMARK_BASELINE为一个json文件路径时，文件不存在就把结果存进去，存在就和它对比，慢了10%以上的会标出来
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import socket
+import sys
+import tempfile
+import time
+
+import httpx
+
+from Downloader import Downloader
+from FakeServer import run_server
+from Scheduler import ConnectionLimiter
+from Writer import FileWriter
+
+
+def interleaved_chunks(size: int, range_count: int, chunk_size: int):
+    """模拟多个范围同时下载时收到的数据，各个范围的数据交替出现"""
+    data = os.urandom(chunk_size)
+    range_size = size // range_count
+    positions = [i * range_size for i in range(range_count)]
+    ends = positions[1:] + [size]
+    while True:
+        done = True
+        for i in range(range_count):
+            if positions[i] < ends[i]:
+                length = min(chunk_size, ends[i] - positions[i])
+                yield data[:length], positions[i]
+                positions[i] += length
+                done = False
+        if done:
+            return
+
+
+async def write_with_aiofiles(path: str, chunks):
+    import aiofiles
+    async with aiofiles.open(path, "wb") as file:
+        for chunk, offset in chunks:
+            await file.seek(offset)
+            await file.write(chunk)
+
+
+async def write_with_file_writer(path: str, size: int, chunks):
+    async with FileWriter(path, size) as writer:
+        for chunk, offset in chunks:
+            await writer.write_async(chunk, offset)
+
+
+def bench_writer(size=64 * 1024 * 1024, range_count=16, chunk_size=1024):
+    """对比aiofiles的seek+write和FileWriter的批量pwrite"""
+    print(f"写入测试: {size // 1024 // 1024}MB, {range_count}个范围, 每块{chunk_size}字节")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.bin")
+        cases = {
+            "aiofiles": lambda: write_with_aiofiles(path, interleaved_chunks(size, range_count, chunk_size)),
+            "FileWriter": lambda: write_with_file_writer(path, size, interleaved_chunks(size, range_count, chunk_size)),
+        }
+        for name, case in cases.items():
+            start, cpu_start = time.perf_counter(), time.process_time()
+            asyncio.run(case())
+            elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+            print(f"{name:>12}: {elapsed:.2f}s, CPU {cpu:.2f}s, {size / elapsed / 1024 / 1024:.1f}MB/s")
+            os.remove(path)
+
+
+def range_app(data: bytes, latency: float = 0.0, chunk_size: int = 64 * 1024):
+    """
+    支持Range的最简单的ASGI应用
+    :param latency: 每个请求返回响应头之前等待的秒数，模拟网络延迟
+    """
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                await send({"type": message["type"] + ".complete"})
+                if message["type"] == "lifespan.shutdown":
+                    return
+        headers = dict(scope["headers"])
+        status, start, end = 200, 0, len(data) - 1
+        match = re.fullmatch(rb"bytes=(\d+)-(\d*)", headers.get(b"range", b""))
+        if match:
+            status, start = 206, int(match[1])
+            end = min(int(match[2]), end) if match[2] else end
+        response_headers = [(b"content-length", str(end - start + 1).encode()), (b"accept-ranges", b"bytes"),
+                            (b"etag", b'"bench"')]
+        if status == 206:
+            response_headers.append((b"content-range", f"bytes {start}-{end}/{len(data)}".encode()))
+        if latency:
+            await asyncio.sleep(latency)
+        await send({"type": "http.response.start", "status": status, "headers": response_headers})
+        view = memoryview(data)
+        for position in range(start, end + 1, chunk_size):
+            await send({"type": "http.response.body", "body": bytes(view[position:min(position + chunk_size, end + 1)]),
+                        "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    return app
+
+
+def serve_range_app(port: int, size: int, latency: float):
+    """在子进程中运行，hypercorn同时支持HTTP/1.1和明文HTTP/2(prior knowledge)"""
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.loglevel = "WARNING"
+    logging.getLogger("asyncio").setLevel(logging.CRITICAL)  # 客户端提前断开时会刷屏
+    asyncio.run(serve(range_app(random.Random(0).randbytes(size), latency), config))
+
+
+def wait_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+async def download_once(client: httpx.AsyncClient, url: str, **options) -> tuple[float, float]:
+    """返回(第一块数据的延迟, 总时间)"""
+    async with Downloader(client, loop=asyncio.get_running_loop(), **options) as downloader:
+        start = time.perf_counter()
+        first = 0.0
+        async for chunk, offset, length in downloader.download_async(url):
+            if not first:
+                first = time.perf_counter() - start
+        return first, time.perf_counter() - start
+
+
+async def check_http2_limit(url: str, data: bytes):
+    """
+    每个主机只允许一个连接时，HTTP/2下载应该只占用探测请求的那一个连接，不能自己等自己
+    先用一个新的下载器(探测响应会留给下载)，再用同一个下载器下载第二次(探测结果已缓存)，卡住时会超时
+    """
+    limiter = ConnectionLimiter(max_connections_per_host=1)
+    expected = hashlib.sha256(data).hexdigest()
+    async with Downloader(httpx.AsyncClient(http1=False, http2=True), loop=asyncio.get_running_loop(),
+                          limiter=limiter) as downloader:
+        for _ in range(2):
+            buffer = bytearray(len(data))
+            async for chunk, offset, length in downloader.download_async(url):
+                buffer[offset:offset + length] = chunk
+            if hashlib.sha256(buffer).hexdigest() != expected:
+                raise RuntimeError("HTTP/2下载的数据不对")
+            if limiter.active:
+                raise RuntimeError(f"下载结束后还占用着{limiter.active}个连接")
+
+
+def bench_http2(size=128 * 1024 * 1024, workers=16, latency=0.02, rounds=3, port=18443):
+    """
+    对比HTTP/1.1(每个范围一个连接)和HTTP/2(所有范围在一个连接上多路复用)
+    本机测试没有TLS握手，latency模拟的是每个请求的往返延迟
+    """
+    try:
+        import h2, hypercorn  # noqa: F401
+    except ImportError:
+        print("HTTP/2测试需要安装h2和hypercorn，跳过")
+        return
+    print(f"HTTP/2测试: {size // 1024 // 1024}MB, {workers}个并发, 每个请求延迟{latency * 1000:.0f}ms")
+    server = multiprocessing.Process(target=serve_range_app, args=(port, size, latency), daemon=True)
+    server.start()
+    try:
+        wait_port(port)
+        url = f"http://127.0.0.1:{port}/bench.bin"
+        cases = {
+            "HTTP/1.1": lambda: httpx.AsyncClient(limits=httpx.Limits(max_connections=workers)),
+            "HTTP/2": lambda: httpx.AsyncClient(http1=False, http2=True),
+        }
+        for name, make_client in cases.items():
+            results = [asyncio.run(download_once(make_client(), url, max_workers=workers, max_streams=workers))
+                       for _ in range(rounds)]
+            first = min(r[0] for r in results)
+            total = min(r[1] for r in results)
+            print(f"{name:>12}: 首字节 {first * 1000:.1f}ms, 总时间 {total:.2f}s, {size / total / 1024 / 1024:.1f}MB/s")
+        asyncio.run(asyncio.wait_for(check_http2_limit(url, random.Random(0).randbytes(size)), 60))
+        print("HTTP/2每个主机一个连接: 正常")
+    finally:
+        server.terminate()
+        server.join()
+
+
+def mock_client(data: bytes, chunk_size: int = 64 * 1024) -> httpx.AsyncClient:
+    """不经过网络的客户端，支持范围请求，数据按chunk_size分块返回，用来测试下载器自己的开销"""
+    class Body(httpx.AsyncByteStream):
+        def __init__(self, start: int, end: int):
+            self.start, self.end = start, end
+
+        async def __aiter__(self):
+            view = memoryview(data)
+            for position in range(self.start, self.end + 1, chunk_size):
+                yield bytes(view[position:min(position + chunk_size, self.end + 1)])
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        status, start, end = 200, 0, len(data) - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", request.headers.get("range", ""))
+        if match:
+            status, start = 206, int(match[1])
+            end = min(int(match[2]), end) if match[2] else end
+        headers = {"content-length": str(end - start + 1), "accept-ranges": "bytes", "etag": '"bench"'}
+        if status == 206:
+            headers["content-range"] = f"bytes {start}-{end}/{len(data)}"
+        return httpx.Response(status, headers=headers, stream=Body(start, end))
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def bench_sync(size=256 * 1024 * 1024, workers=8, rounds=3):
+    """
+    对比同步和异步接口在高带宽下的吞吐量，数据不经过网络，差距就是跨线程交接的开销
+    逐块交出(sync_batch_size=0)相当于原来每块都经过一次队列
+    """
+    print(f"同步/异步测试: {size // 1024 // 1024}MB, {workers}个并发")
+    data = os.urandom(size)
+    url = "http://bench/bench.bin"
+
+    def consume(downloader: Downloader, path: str):
+        with FileWriter(path, size) as writer:
+            for chunk, offset, length in downloader.download(url):
+                writer.write(chunk, offset)
+
+    async def save_async(path: str):
+        async with Downloader(mock_client(data), loop=asyncio.get_running_loop(), max_workers=workers) as downloader:
+            await downloader.save_async(url, path)
+
+    def run_sync(path: str, target, **options):
+        with Downloader(mock_client(data), max_workers=workers, **options) as downloader:
+            target(downloader, path)
+
+    cases = {
+        "异步save_async": lambda path: asyncio.run(save_async(path)),
+        "同步save": lambda path: run_sync(path, lambda d, p: d.save(url, p)),
+        "同步download(成批)": lambda path: run_sync(path, consume),
+        "同步download(逐块)": lambda path: run_sync(path, consume, sync_batch_size=0),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.bin")
+        for name, case in cases.items():
+            times = []
+            for _ in range(rounds):
+                start = time.perf_counter()
+                case(path)
+                times.append(time.perf_counter() - start)
+                os.remove(path)
+            best = min(times)
+            print(f"{name:>16}: {best:.2f}s, {size / best / 1024 / 1024:.1f}MB/s")
+
+
+def peak_rss() -> int:
+    """当前进程的峰值内存，字节，不支持的系统返回0"""
+    try:
+        import resource
+    except ImportError:  # Windows
+        try:
+            import psutil
+        except ImportError:
+            return 0
+        return getattr(psutil.Process().memory_info(), "peak_wset", 0)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024  # Linux上单位是KB
+
+
+def measure(url: str, options: dict) -> dict:
+    """在单独的子进程中下载一次，峰值内存和CPU时间只算这一次下载"""
+    async def run() -> int:
+        async with Downloader(loop=asyncio.get_running_loop(), **options) as downloader:
+            size = 0
+            async for chunk, offset, length in downloader.download_async(url):
+                size += length
+            return size
+
+    cpu, start = time.process_time(), time.perf_counter()
+    size = asyncio.run(run())
+    return {"size": size, "seconds": time.perf_counter() - start, "cpu": time.process_time() - cpu, "rss": peak_rss()}
+
+
+def bench_matrix(sizes=(16 * 1024 * 1024, 128 * 1024 * 1024), workers=(1, 8, 32),
+                 min_sizes=(256 * 1024, 4 * 1024 * 1024), chunk_sizes=(None, 8 * 1024 * 1024),
+                 latency=0.005, port=18500):
+    """
+    在FakeServer上跑max_workers、worker_min_download_size、文件大小、chunk_size的所有组合，
+    再用默认参数跑几种不好的服务器：每个连接限速、随机断开、不支持Range
+    每次下载都在新的子进程中进行，服务器也在单独的进程中，CPU时间和峰值内存只算下载器自己
+    """
+    profiles = {
+        "限速": {"bandwidth": 4 * 1024 * 1024},
+        "断线": {"drop_rate": 0.2, "seed": 0},
+        "无Range": {"ignore_range": True},
+    }
+    servers = [({"size": size, "latency": latency}, [
+        ("正常", size, {"max_workers": w, "worker_min_download_size": m, "chunk_size": c})
+        for w, m, c in itertools.product(workers, min_sizes, chunk_sizes)]) for size in sizes]
+    servers += [({"size": sizes[0], "latency": latency, **server}, [(name, sizes[0], {"max_workers": max(workers)})])
+                for name, server in profiles.items()]
+
+    baseline_path = os.environ.get("BENCHMARK_BASELINE", "")
+    baseline = {}
+    if baseline_path and os.path.exists(baseline_path):
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    results = {}
+    print(f"{'服务器':<6}{'大小MB':>8}{'并发':>6}{'最小分段KB':>12}{'领取KB':>10}{'MB/s':>10}{'CPU秒':>8}{'峰值内存MB':>12}")
+    context = multiprocessing.get_context("spawn")
+    for index, (server_options, cases) in enumerate(servers):
+        server = context.Process(target=run_server, kwargs={"port": port + index, **server_options}, daemon=True)
+        server.start()
+        try:
+            wait_port(port + index)
+            url = f"http://127.0.0.1:{port + index}/bench.bin"
+            for name, size, options in cases:
+                with context.Pool(1, maxtasksperchild=1) as pool:
+                    result = pool.apply(measure, (url, options))
+                if result["size"] != size:
+                    raise RuntimeError(f"{name} {options}: 下载了{result['size']}字节，应该是{size}")
+                key = f"{name}/{size}/" + "/".join(f"{k}={v}" for k, v in options.items())
+                results[key] = result
+                speed = size / result["seconds"] / 1024 / 1024
+                mark = ""
+                if key in baseline:
+                    old = size / baseline[key]["seconds"] / 1024 / 1024
+                    if speed < old * 0.9:
+                        mark = f"  比基准慢{(1 - speed / old) * 100:.0f}%"
+                print(f"{name:<6}{size // 1024 // 1024:>8}{options['max_workers']:>6}"
+                      f"{options.get('worker_min_download_size', 1024 * 1024) // 1024:>12}"
+                      f"{(options.get('chunk_size') or 0) // 1024 or '-':>10}{speed:>10.1f}{result['cpu']:>8.2f}"
+                      f"{result['rss'] / 1024 / 1024:>12.1f}{mark}", flush=True)
+        finally:
+            server.terminate()
+            server.join()
+    if baseline_path and not baseline:
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到{baseline_path}")
+
+
+if __name__ == '__main__':
+    benches = {"writer": bench_writer, "http2": bench_http2, "sync": bench_sync, "matrix": bench_matrix}
+    for name in sys.argv[1:] or benches:
+        benches[name]()
@@ -0,0 +1,138 @@
+"""
+get/get_async的缓存，适合反复获取的小文件，比如配置、索引
+- 按url缓存整个文件，再次获取时带上If-None-Match/If-Modified-Since向服务器确认，没变(304)就直接用缓存
+- 按字节数限制内存占用，超过后淘汰最久没用的；设置了spill_dir时淘汰的文件先写到磁盘上，再次用到时读回内存
+- 返回只读的memoryview，不复制数据
+"""
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Optional, Union
+
+
+class CacheEntry:
+    __slots__ = ("url", "data", "etag", "last_modified", "size", "path")
+
+    def __init__(self, url: str, data: Union[bytes, bytearray, memoryview], etag: str = "", last_modified: str = ""):
+        self.url = url
+        self.data = data  # 写到磁盘上后为None
+        self.etag = etag
+        self.last_modified = last_modified
+        self.size = len(data)
+        self.path = ""  # 写到磁盘上的路径
+
+    @property
+    def validators(self) -> dict[str, str]:
+        """向服务器确认时要带的请求头，为空代表没法确认，只能重新下载"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def view(self) -> memoryview:
+        return memoryview(self.data).toreadonly()
+
+
+class DownloadCache:
+    """
+    按字节数限制大小的LRU缓存，只在事件循环线程中使用，不需要加锁
+    """
+    def __init__(self, max_size: int = 64 * 1024 * 1024, spill_dir: str = "", max_spill_size: int = 1024 * 1024 * 1024):
+        """
+        :param max_size: 内存中最多缓存多少字节
+        :param spill_dir: 从内存中淘汰的文件写到这个目录，为空时直接丢弃
+        :param max_spill_size: 磁盘上最多缓存多少字节，超过后删除最久没用的
+        """
+        self.max_size = max_size
+        self.spill_dir = spill_dir
+        self.max_spill_size = max_spill_size
+        self.size = 0
+        self.spill_size = 0
+        self._memory: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._spilled: OrderedDict[str, CacheEntry] = OrderedDict()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __contains__(self, url: str) -> bool:
+        return url in self._memory or url in self._spilled
+
+    def __len__(self) -> int:
+        return len(self._memory) + len(self._spilled)
+
+    def get(self, url: str) -> Optional[CacheEntry]:
+        """取出缓存，在磁盘上的会读回内存"""
+        entry = self._memory.get(url)
+        if entry is not None:
+            self._memory.move_to_end(url)
+            return entry
+        entry = self._spilled.pop(url, None)
+        if entry is None:
+            return None
+        self.spill_size -= entry.size
+        try:
+            with open(entry.path, "rb") as f:
+                data = f.read()
+            os.remove(entry.path)
+        except OSError:  # 被别人删了
+            return None
+        if len(data) != entry.size:
+            return None
+        return self.put(url, data, entry.etag, entry.last_modified)
+
+    def put(self, url: str, data: Union[bytes, bytearray, memoryview], etag: str = "", last_modified: str = "") -> CacheEntry:
+        """放入缓存，比max_size还大的直接写到磁盘上(或者不缓存)，返回的CacheEntry始终带着数据"""
+        self.remove(url)
+        entry = CacheEntry(url, data, etag, last_modified)
+        if entry.size > self.max_size:
+            self._spill(CacheEntry(url, data, etag, last_modified))
+            return entry
+        self._memory[url] = entry
+        self.size += entry.size
+        while self.size > self.max_size:
+            _, oldest = self._memory.popitem(last=False)
+            self.size -= oldest.size
+            self._spill(oldest)
+        return entry
+
+    def remove(self, url: str):
+        entry = self._memory.pop(url, None)
+        if entry is not None:
+            self.size -= entry.size
+        entry = self._spilled.pop(url, None)
+        if entry is not None:
+            self.spill_size -= entry.size
+            self._unlink(entry)
+
+    def clear(self):
+        for entry in self._spilled.values():
+            self._unlink(entry)
+        self._memory.clear()
+        self._spilled.clear()
+        self.size = self.spill_size = 0
+
+    def _spill(self, entry: CacheEntry):
+        if not self.spill_dir or entry.size > self.max_spill_size:
+            return
+        entry.path = os.path.join(self.spill_dir, hashlib.sha256(entry.url.encode("utf-8")).hexdigest())
+        try:
+            with open(entry.path, "wb") as f:
+                f.write(entry.data)
+        except OSError:
+            self._unlink(entry)
+            return
+        entry.data = None
+        self._spilled[entry.url] = entry
+        self.spill_size += entry.size
+        while self.spill_size > self.max_spill_size:
+            _, oldest = self._spilled.popitem(last=False)
+            self.spill_size -= oldest.size
+            self._unlink(oldest)
+
+    @staticmethod
+    def _unlink(entry: CacheEntry):
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
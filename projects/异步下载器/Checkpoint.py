@@ -0,0 +1,143 @@
+import bisect
+import json
+import os
+from typing import Optional
+
+
+class Checkpoint:
+    """
+    断点续传记录文件，和下载文件放在一起(文件名后面加上.ckpt)
+    第一行是json格式的文件信息，之后每一行是一个已下载完成的范围"开始 结束"(左闭右开)，只追加不修改
+    """
+    suffix = ".ckpt"
+
+    def __init__(self, path: str, url: str, content_length: int, etag: str = "", last_modified: str = ""):
+        """
+        :param path: 记录文件路径
+        :param url: 下载地址
+        :param content_length: 文件大小
+        :param etag: 响应头中的ETag
+        :param last_modified: 响应头中的Last-Modified
+        """
+        self.path = path
+        self.url = url
+        self.content_length = content_length
+        self.etag = etag
+        self.last_modified = last_modified
+        self._done: list[list[int]] = []  # 已写入记录文件的范围，有序且不重叠
+        self._pending: dict[int, int] = {}  # 还没写入记录文件的范围，结束位置->开始位置
+        self._pending_size = 0
+
+    @classmethod
+    def for_file(cls, file: str) -> str:
+        """获取下载文件对应的记录文件路径"""
+        return file + cls.suffix
+
+    @classmethod
+    def load(cls, path: str) -> Optional["Checkpoint"]:
+        """读取记录文件，文件不存在或者损坏时返回None"""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                info = json.loads(f.readline())
+                checkpoint = cls(path, info["url"], info["length"], info["etag"], info["last_modified"])
+                for line in f:
+                    parts = line.split()
+                    if len(parts) != 2:  # 最后一行可能没写完
+                        break
+                    checkpoint._merge(int(parts[0]), int(parts[1]))
+        except (OSError, ValueError, KeyError):
+            return None
+        return checkpoint
+
+    def create(self):
+        """新建记录文件，会覆盖旧的记录"""
+        self._done.clear()
+        self._pending.clear()
+        self._pending_size = 0
+        self._rewrite()
+
+    def compact(self):
+        """把记录文件重写成合并后的范围，避免记录文件越来越大"""
+        self.flush()
+        self._rewrite()
+
+    def remove(self):
+        """下载完成后删除记录文件"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def matches(self, url: str, content_length: int, etag: str = "", last_modified: str = "") -> bool:
+        """判断远程文件是否和记录时一样，没有ETag和Last-Modified时只比较大小"""
+        return (self.url == url
+                and self.content_length == content_length
+                and self.etag == etag
+                and self.last_modified == last_modified)
+
+    def add(self, offset: int, length: int):
+        """记录已经写入的数据，只保存在内存中，需要调用flush才会写入记录文件"""
+        end = offset + length
+        start = self._pending.pop(offset, offset)  # 大部分情况下是接着上次的数据
+        self._pending[end] = start
+        self._pending_size += length
+
+    @property
+    def pending_size(self) -> int:
+        """还没写入记录文件的数据大小"""
+        return self._pending_size
+
+    def flush(self):
+        """
+        将内存中的记录追加到记录文件
+        注意：调用前需要先确保数据已经写入下载文件，否则中断后会认为没写入的数据已下载
+        """
+        if not self._pending:
+            return
+        lines = []
+        for end, start in self._pending.items():
+            self._merge(start, end)
+            lines.append(f"{start} {end}\n")
+        self._pending.clear()
+        self._pending_size = 0
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+
+    @property
+    def completed(self) -> int:
+        """已记录的下载大小"""
+        return sum(end - start for start, end in self._done) + self._pending_size
+
+    def missing_ranges(self) -> list[tuple[int, int]]:
+        """获取还没下载的范围，格式和Range请求头一样是闭区间"""
+        ranges = []
+        position = 0
+        for start, end in self._done:
+            if start > position:
+                ranges.append((position, start - 1))
+            position = max(position, end)
+        if position < self.content_length:
+            ranges.append((position, self.content_length - 1))
+        return ranges
+
+    def _merge(self, start: int, end: int):
+        """将范围合并到已记录范围中"""
+        if start >= end:
+            return
+        i = bisect.bisect_left(self._done, [start, start])
+        if i > 0 and self._done[i - 1][1] >= start:  # 和前一个范围相连
+            i -= 1
+            start = self._done[i][0]
+        j = i
+        while j < len(self._done) and self._done[j][0] <= end:  # 吞掉后面相连的范围
+            end = max(end, self._done[j][1])
+            j += 1
+        self._done[i:j] = [[start, end]]
+
+    def _rewrite(self):
+        info = {"url": self.url, "length": self.content_length, "etag": self.etag, "last_modified": self.last_modified}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(json.dumps(info, ensure_ascii=False) + "\n")
+            f.writelines(f"{start} {end}\n" for start, end in self._done)
+        os.replace(tmp, self.path)
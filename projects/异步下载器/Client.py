@@ -2,11 +2,9 @@ import asyncio
 import pathlib
 from types import FunctionType
 
-import aiofiles
 from PyQt5.QtCore import QThread, pyqtSignal, pyqtBoundSignal
-from httpx import AsyncClient
 
-from Downloader import Downloader
+from Manager import DownloadManager, DownloadJob
 from Options import Options
 from Window import Window
 
@@ -33,56 +31,48 @@ class Client(Window):
         self.loop = asyncio.new_event_loop()
         self.loop_thread = LoopThread(self.loop)
         self.loop_thread.start()
-        self.downloader_map: dict[Options, Downloader] = {}
+        # 所有下载项共用一个下载管理器，共享连接池和连接数限制
+        self.manager = DownloadManager(loop=self.loop)
+        self.job_map: dict[Options, DownloadJob] = {}
+        # 进度快照由事件循环线程按节奏发布，定时器只看当前标签页，值没变就不重绘
         self.update_progress_bar_timer_id = self.startTimer(120)
 
     def start_download(self, options: Options):
-        client = AsyncClient(proxies=options.proxy or None, timeout=50, verify=False)
-        downloader = Downloader(loop=self.loop, http_client=client)
-        self.downloader_map[options] = downloader
-        asyncio.run_coroutine_threadsafe(self.start_and_monitor(downloader, options), self.loop)
+        path = pathlib.Path(options.save_path, options.file_name)
+        options.progress.reset()
+        options.failed = False
+        job = self.manager.add(options.url, str(path), proxy=options.proxy,
+                               on_done=lambda j: self.on_job_done(options, j), on_progress=options.progress.update)
+        self.job_map[options] = job
         options.started = True
 
     def on_change_tab(self, index):
         super().on_change_tab(index)
         self.update_progress_bar()
 
-    async def start_and_monitor(self, downloader, options):
-        path = pathlib.Path(options.save_path, options.file_name)
-        options.download_size = 0
-        options.failed = False
-        try:
-            async with downloader:
-                options.file_size = await downloader.get_content_length_async(options.url, follow_redirects=True)
-                async with aiofiles.open(path, "wb") as file:
-                    async for chunk, offset, length in downloader.download_async(options.url, follow_redirects=True):
-                        await file.seek(offset)
-                        await file.write(chunk)
-                        options.download_size += length
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            if not isinstance(e, RuntimeError):  # 如果http客户端被关闭(只有下载暂停时才是)，则是RuntimeError
-                tab = self.tab_bar.tab(options)
-                if tab is not None:
-                    e_str = str(e)
-                    self.execute_signal.emit(lambda: self.tip(tab, "下载失败", e_str))
-                options.failed = True
-            options.started = False
-            path.unlink(missing_ok=True)
-            self.execute_signal.emit(
-                lambda: (self.update_progress_bar(), self.update_option()))  # 分开提交会导致第二个提交的任务不会执行？？？
-        else:
+    def on_job_done(self, options: Options, job: DownloadJob):
+        """下载结束时在事件循环线程中调用"""
+        if self.job_map.get(options) is job:
+            self.job_map.pop(options)
+        options.progress.publish()
+        options.started = False
+        if job.state == DownloadJob.FINISHED:
             options.finished = True
-            options.started = False
             tab = self.tab_bar.tab(options)
             if tab is not None:
                 self.execute_signal.emit(
                     lambda: (self.teaching_tip(tab, "下载完成", options.file_name), self.update_option()))
             else:
                 self.execute_signal.emit(self.update_option)
-        finally:
-            self.downloader_map.pop(options)
+            return
+        if job.state == DownloadJob.FAILED:  # 取消(暂停)不算失败，已下载的部分会保留，下次接着下
+            tab = self.tab_bar.tab(options)
+            if tab is not None:
+                e_str = str(job.error)
+                self.execute_signal.emit(lambda: self.tip(tab, "下载失败", e_str))
+            options.failed = True
+        self.execute_signal.emit(
+            lambda: (self.update_progress_bar(), self.update_option()))  # 分开提交会导致第二个提交的任务不会执行？？？
 
     def timerEvent(self, a0):
         if a0.timerId() == self.update_progress_bar_timer_id:
@@ -92,8 +82,8 @@ class Client(Window):
             super().timerEvent(a0)
 
     def stop_download(self, options: Options):
-        downloader = self.downloader_map.pop(options)
-        downloader.close(False)
+        job = self.job_map.pop(options)
+        self.manager.cancel(job)
         options.started = False
 
     def bind_signals(self):
@@ -101,7 +91,6 @@ class Client(Window):
         self.execute_signal.connect(lambda x: x())
 
     def closeEvent(self, a0):
-        for downloader in self.downloader_map.values():
-            downloader.close(False)
+        self.manager.close()
         self.loop.call_soon_threadsafe(self.loop.stop)
         self.loop_thread.wait()
@@ -1,12 +1,65 @@
 import asyncio
+import concurrent.futures
+import contextlib
+import datetime
+import email.utils
 import io
+import logging
+import os
+import random
+import re
 import threading
+import time
 from queue import Queue
-from typing import Union, Optional, AsyncGenerator, Generator
+from typing import Union, Optional, AsyncGenerator, Generator, Callable
 from urllib.parse import urlparse
 
+import httpx
 from httpx import AsyncClient
 
+from Cache import DownloadCache, CacheEntry
+from Checkpoint import Checkpoint
+from Integrity import StreamHasher, IntegrityError
+from Metrics import DownloadMetrics, WorkerMetrics, Observer
+from Scheduler import (
+    RangeScheduler, Segment, ChunkSize, ConcurrencyController, MemoryBudget, ConnectionLimiter, TokenBucket,
+    MirrorSelector)
+from Writer import FileWriter
+
+logger = logging.getLogger(__name__)
+
+Sources = Union[str, list[str]]  # 下载地址，或者同一个文件的多个镜像地址，第一个是主地址
+
+
+class IncompleteReadError(Exception):
+    """响应提前结束，收到的数据比请求的范围少"""
+
+
+class RangeError(Exception):
+    """服务器没有按请求的范围返回数据，或者文件在下载过程中变了"""
+
+
+class ResourceInfo:
+    """探测请求得到的远程文件信息"""
+    __slots__ = ("content_length", "accept_ranges", "etag", "last_modified", "http_version")
+
+    def __init__(self, content_length: int, accept_ranges: bool, etag: str = "", last_modified: str = "",
+                 http_version: str = "HTTP/1.1"):
+        self.content_length = content_length  # 0代表未知
+        self.accept_ranges = accept_ranges
+        self.etag = etag
+        self.last_modified = last_modified
+        self.http_version = http_version
+
+    @property
+    def multiplexed(self) -> bool:
+        """是否是HTTP/2，多个请求可以在同一个连接上同时进行"""
+        return self.http_version == "HTTP/2"
+
+    def __repr__(self):
+        return (f"ResourceInfo({self.content_length}, accept_ranges={self.accept_ranges}, etag={self.etag!r}, "
+                f"{self.http_version})")
+
 
 class Downloader:
     """异步下载器"""
@@ -14,17 +67,76 @@ class Downloader:
                  http_client: Optional[AsyncClient] = None,
                  max_workers: int = 30,
                  worker_min_download_size=1024 * 1024,
-                 loop: Optional[asyncio.AbstractEventLoop] = None):
+                 loop: Optional[asyncio.AbstractEventLoop] = None,
+                 checkpoint_interval=4 * 1024 * 1024,
+                 chunk_size: ChunkSize = None,
+                 adaptive=False,
+                 block_size=256 * 1024,
+                 max_buffer_size=64 * 1024 * 1024,
+                 max_retries=10,
+                 retry_backoff=0.5,
+                 retry_max_delay=30.0,
+                 probe_retries=3,
+                 limiter: Optional[ConnectionLimiter] = None,
+                 rate_limiter: Optional[TokenBucket] = None,
+                 probe_cache: Optional[dict[str, ResourceInfo]] = None,
+                 http2=False,
+                 max_streams=16,
+                 observer: Optional[Observer] = None,
+                 metrics_interval=1.0,
+                 sync_batch_size=4 * 1024 * 1024,
+                 cache: Optional[DownloadCache] = None):
         """
         异步下载器，在创建时会开启一个线程，用于异步下载文件
         :param http_client: 异步Http客户端
         :param max_workers: 最大工作任务数
         :param worker_min_download_size: 每个工作任务最少下载大小
         :param loop: 事件循环，如果不指定则创建一个新事件循环，并在新线程中运行，也可以指定为asyncio.get_event_loop()，但之后就只能用异步了
+        :param checkpoint_interval: 断点续传时，每下载多少数据更新一次记录文件
+        :param chunk_size: 工作任务每次领取的下载大小，详见RangeScheduler，
+            下载完自己的部分后，空闲的工作任务会分走最慢的工作任务剩下的一半，不会小于worker_min_download_size
+        :param adaptive: 自适应并发数，从少量连接开始，根据测得的速度增减连接数，max_workers是上限
+        :param block_size: 每次交给调用者的数据大小，网络上收到的小块数据会先合并成这么大，越大CPU占用越低，但进度更新越慢
+        :param max_buffer_size: 所有下载中已下载但还没被处理的数据最多占用多少内存，超过后工作任务会暂停读取
+        :param max_retries: 每次下载最多重试多少次(所有范围共用)，超时、连接断开、5xx、429等错误会从断开的位置继续下载
+        :param retry_backoff: 第一次重试前等待的秒数，之后每次翻倍
+        :param retry_max_delay: 重试前最多等待多少秒，也会限制Retry-After
+        :param probe_retries: 探测请求最多重试多少次，单独计数，比max_retries少，连不上服务器时很快就会失败
+        :param limiter: 连接数限制，多个下载器共用时可以限制总连接数，见DownloadManager
+        :param rate_limiter: 限速，多个下载器共用时限制总速度
+        :param probe_cache: 探测结果的缓存，url->ResourceInfo，多个下载器可以共用；每次下载开始时都会重新探测，
+            同一个下载中的其他步骤(预分配、HTTP/2判断、镜像核对)直接用缓存
+        :param http2: 没有指定http_client时，创建的客户端是否启用HTTP/2(需要安装h2)
+        :param max_streams: 服务器使用HTTP/2时，所有范围在同一个连接上同时下载，这时用它代替max_workers限制并发数；
+            每个流有自己的流量控制窗口，处理得慢时只会暂停自己的流，连接数限制也只算一个连接
+        :param observer: 统计回调，参数是(事件, DownloadMetrics)，每个下载开始时是start，之后每隔metrics_interval秒一次update，
+            结束时是finish，在事件循环线程中调用
+        :param metrics_interval: 更新统计(速度、卡住的次数)和调用observer的间隔，秒
+        :param sync_batch_size: 同步下载时，调用者处理得慢的话，事件循环线程最多攒多少数据一次交给调用者
+        :param cache: get/get_async的缓存，设置后再次获取同一个url时先向服务器确认，没变就直接用缓存，返回值变为memoryview
         """
-        self.http_client = http_client or AsyncClient()
+        self.http_client = http_client or AsyncClient(http2=http2)
         self.max_workers = max_workers
         self.worker_min_download_size = worker_min_download_size
+        self.checkpoint_interval = checkpoint_interval
+        self.chunk_size = chunk_size
+        self.adaptive = adaptive
+        self.block_size = block_size
+        self.budget = MemoryBudget(max_buffer_size)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.retry_max_delay = retry_max_delay
+        self.probe_retries = probe_retries
+        self.limiter = limiter
+        self.rate_limiter = rate_limiter
+        self.probe_cache = {} if probe_cache is None else probe_cache
+        self.max_streams = max_streams
+        self.observer = observer
+        self.metrics_interval = metrics_interval
+        self.sync_batch_size = sync_batch_size
+        self.cache = cache
+        self.downloads: list[DownloadMetrics] = []  # 正在进行的下载的统计
+        self._probe_responses: dict[str, tuple[contextlib.AsyncExitStack, httpx.Response]] = {}  # 留给下载用的探测响应
         self.thread: Optional[threading.Thread] = None
         if loop:
             self.loop = loop
@@ -53,7 +165,7 @@ class Downloader:
         await self.close_async(self.thread is not None)
 
     def close(self, stop_loop=True):
-        future = asyncio.run_coroutine_threadsafe(self.http_client.aclose(), self.loop)
+        future = asyncio.run_coroutine_threadsafe(self.close_async(False), self.loop)
         future.result()
         if stop_loop:
             self.loop.call_soon_threadsafe(self.loop.stop)
@@ -61,46 +173,169 @@ class Downloader:
                 self.thread.join()
 
     async def close_async(self, stop_loop=True):
+        await self.release_probes_async()
         await self.http_client.aclose()
         if stop_loop:
             self.loop.stop()
 
-    def get(self, url: str, **kwargs) -> bytes:
+    async def _release_probe(self, url: str):
+        """关闭留给url的下载但没被用上的探测响应"""
+        probe = self._probe_responses.pop(url, None)
+        if probe is not None:
+            await self._discard(probe)
+
+    async def release_probes_async(self):
+        """关闭留给下载用但没被用上的探测响应，归还它们占用的连接，http_client是共用的时候用它代替close_async"""
+        while self._probe_responses:
+            _, (stack, _) = self._probe_responses.popitem()
+            await stack.aclose()
+
+    @property
+    def buffered_size(self) -> int:
+        """当前已下载但还没被处理的数据大小"""
+        return self.budget.used
+
+    def get(self, url: str, **kwargs) -> Union[bytes, memoryview]:
+        if self.cache is not None:
+            return self._run_sync(self.get_async(url, **kwargs))
         cache = io.BytesIO()
         self.save(url, file=cache, close=False, **kwargs)
         return cache.getvalue()
 
-    async def get_async(self, url: str, **kwargs) -> bytes:
-        cache = io.BytesIO()
-        await self.save_async(url, file=cache, close=False, **kwargs)
-        return cache.getvalue()
+    async def get_async(self, url: str, **kwargs) -> Union[bytes, memoryview]:
+        """
+        下载整个文件到内存
+        设置了cache时返回只读的memoryview，不复制数据；缓存过的url先向服务器确认有没有变，没变就不用再下载
+        """
+        if self.cache is None:
+            cache = io.BytesIO()
+            await self.save_async(url, file=cache, close=False, **kwargs)
+            return cache.getvalue()
+        entry = self.cache.get(url)
+        if entry is not None and entry.validators:
+            entry = await self._revalidate(entry, **kwargs)
+            if entry is not None:
+                return entry.view()
+        info = await self._probe_fresh(url, **kwargs)  # 要拿到最新的ETag和Last-Modified
+        if info.content_length:  # 知道大小时直接写进最终的缓冲区
+            buffer = bytearray(info.content_length)
+            view = memoryview(buffer)
+            async for chunk, offset, length in self.download_async(url, **kwargs):
+                view[offset:offset + length] = chunk
+            view.release()
+            data = buffer
+        else:
+            stream = io.BytesIO()
+            async for chunk, offset, length in self.download_async(url, **kwargs):
+                stream.seek(offset)
+                stream.write(chunk)
+            data = stream.getbuffer()
+        return self.cache.put(url, data, info.etag, info.last_modified).view()
 
-    def save(self, url: str, file: Union[io.IOBase, str, None] = None, close=True, **kwargs):
-        if file is None:
-            file = urlparse(url).path.split("/")[-1]
-        is_open_file = isinstance(file, str)
-        if is_open_file:
-            file = open(file, "wb")
+    async def _revalidate(self, entry: CacheEntry, **kwargs) -> Optional[CacheEntry]:
+        """
+        带上条件请求头向服务器确认缓存是否还能用，没变(304)时返回原来的缓存，变了(200)时直接用这次的响应更新缓存，
+        其他情况返回None，交给正常的下载流程
+        """
+        kwargs["headers"] = {**kwargs.get("headers", {}), **entry.validators}
+        async with contextlib.AsyncExitStack() as stack:
+            await stack.enter_async_context(self._connection(entry.url))
+            response = await stack.enter_async_context(self.http_client.stream("GET", entry.url, **kwargs))
+            if response.status_code == 304:
+                return entry
+            response.raise_for_status()
+            if response.status_code != 200:
+                return None
+            data = await response.aread()
+        self.probe_cache.pop(entry.url, None)  # 文件变了，探测结果也作废
+        return self.cache.put(entry.url, data, response.headers.get("ETag", ""), response.headers.get("Last-Modified", ""))
+
+    def save(self, url: Sources, file: Union[io.IOBase, str, None] = None, close=True, resume=False,
+             progress: Optional[Callable[[int, int], None]] = None, checksum: str = "",
+             hasher: Optional[StreamHasher] = None, metrics: Optional[DownloadMetrics] = None, **kwargs):
+        """
+        下载并保存到文件
+        :param url: 下载地址，也可以是多个镜像地址，断点续传和默认文件名以第一个为准
+        :param file: 文件对象或路径，是路径时使用FileWriter按位置写入
+        :param resume: 是否断点续传，只有file是路径时有效，下载中断后会保留文件和记录文件，下次保存时只下载缺少的部分
+        :param progress: 进度回调，参数是(已下载大小, 文件大小)，文件大小为0代表未知，只有file是路径时有效，
+            保存到路径时整个保存过程在事件循环线程中进行，progress也在事件循环线程中调用
+        :param checksum: 期望的摘要，格式是"算法:十六进制摘要"，边下载边计算，不一致时抛出IntegrityError，只有file是路径时有效
+        :param hasher: 自定义的StreamHasher，比如需要分块校验时，优先于checksum
+        :param metrics: 传入后下载的统计会记录在里面，保存到路径时还会记录磁盘写入的统计
+        """
+        if file is None or isinstance(file, str):
+            # 直接在事件循环线程中写入文件，和save_async一样快，progress也在事件循环线程中调用
+            return self._run_sync(self.save_async(url, file, close, resume, progress, checksum, hasher, metrics, **kwargs))
+        metrics = metrics or DownloadMetrics(url if isinstance(url, str) else url[0])
         try:
-            for chunk, offset, length in self.download(url, **kwargs):
-                file.seek(offset)
+            position = -1
+            for chunk, offset, length in self.download(url, metrics=metrics, **kwargs):
+                if offset != position:  # 连续的数据不用再seek
+                    file.seek(offset)
                 file.write(chunk)
+                position = offset + length
         finally:
-            if is_open_file:
-                file.close()
-            elif close:
+            if close:
                 file.close()
 
-    async def save_async(self, url: str, file: Union[io.IOBase, str, None] = None, close=True, **kwargs):
-        import aiofiles
+    def _run_sync(self, coro):
+        """在事件循环线程中运行并等待结果，当前线程被中断(比如KeyboardInterrupt)时取消，并等它清理完，比如写完断点续传记录"""
+        result = concurrent.futures.Future()
+        done = threading.Event()  # Future.cancel()不会唤醒concurrent.futures.wait，用Event等
+        task: Optional[asyncio.Task] = None
+
+        def finished(t: asyncio.Task):
+            done.set()
+            if t.cancelled():
+                result.cancel()
+            elif t.exception() is not None:
+                result.set_exception(t.exception())
+            else:
+                result.set_result(t.result())
+
+        def start():
+            nonlocal task
+            task = self.loop.create_task(coro)
+            task.add_done_callback(finished)
+
+        self.loop.call_soon_threadsafe(start)
+        try:
+            return result.result()
+        except BaseException:
+            if not result.done():
+                self.loop.call_soon_threadsafe(lambda: task.cancel())  # start已经先执行了，task一定存在
+                done.wait()
+            raise
+
+    async def save_async(self, url: Sources, file: Union[io.IOBase, str, None] = None, close=True, resume=False,
+                         progress: Optional[Callable[[int, int], None]] = None, checksum: str = "",
+                         hasher: Optional[StreamHasher] = None, metrics: Optional[DownloadMetrics] = None, **kwargs):
+        """
+        异步下载并保存到文件
+        :param url: 下载地址，也可以是多个镜像地址，断点续传和默认文件名以第一个为准
+        :param file: 文件对象、aiofiles文件对象或路径，是路径时使用FileWriter按位置写入
+        :param resume: 是否断点续传，只有file是路径时有效，下载中断后会保留文件和记录文件，下次保存时只下载缺少的部分
+        :param progress: 进度回调，参数是(已下载大小, 文件大小)，文件大小为0代表未知，只有file是路径时有效
+        :param checksum: 期望的摘要，格式是"算法:十六进制摘要"，边下载边计算，不一致时抛出IntegrityError，只有file是路径时有效
+        :param hasher: 自定义的StreamHasher，比如需要分块校验时，优先于checksum
+        :param metrics: 传入后下载的统计会记录在里面，保存到路径时还会记录磁盘写入的统计
+        """
+        primary = url if isinstance(url, str) else url[0]
+        metrics = metrics or DownloadMetrics(primary)
         if file is None:
-            file = urlparse(url).path.split("/")[-1]
-        is_open_file = isinstance(file, str)
-        if is_open_file:
-            file = await aiofiles.open(file, "wb").__aenter__()
-        if isinstance(file, io.IOBase):
+            file = urlparse(primary).path.split("/")[-1]
+        if isinstance(file, str):
+            if hasher is None and checksum:  # 先检查摘要的格式，不要探测之后才出错
+                hasher = StreamHasher.from_checksum(checksum)
+            try:
+                await self._save_file(url, primary, file, resume, progress, hasher, metrics, **kwargs)
+            except BaseException:
+                await self._release_probe(primary)  # 出错时留给下载的探测响应可能还没被用上，不能一直占着连接
+                raise
+        elif isinstance(file, io.IOBase):
             try:
-                for chunk, offset, length in self.download(url, **kwargs):
+                async for chunk, offset, length in self.download_async(url, metrics=metrics, **kwargs):
                     file.seek(offset)
                     file.write(chunk)
             finally:
@@ -108,110 +343,718 @@ class Downloader:
                     file.close()
         else:
             try:
-                async for chunk, offset, length in self.download_async(url, **kwargs):
+                async for chunk, offset, length in self.download_async(url, metrics=metrics, **kwargs):
                     await file.seek(offset)
                     await file.write(chunk)
             finally:
                 if close:
                     await file.close()
 
-    def download(self, url: str, **kwargs) -> Generator[tuple[bytes, int, int], None, None]:
+    async def _save_file(self, url: Sources, primary: str, file: str, resume: bool,
+                         progress: Optional[Callable[[int, int], None]], hasher: Optional[StreamHasher],
+                         metrics: DownloadMetrics, **kwargs):
+        """save_async保存到路径时的实现，使用FileWriter按位置写入"""
+        checkpoint, ranges = (await self.open_checkpoint_async(primary, file, **kwargs)) if resume else (None, None)
+        size = (await self._probe_fresh(primary, **kwargs)).content_length  # 用来预分配，探测的响应留给下载继续用
+        downloaded = checkpoint.completed if checkpoint else 0
+        end = 0
+        if progress:
+            progress(downloaded, size)
+        async with FileWriter(file, size, truncate=ranges is None) as writer:
+            metrics.writer = writer
+            try:
+                async for chunk, offset, length in self.download_async(url, ranges=ranges, metrics=metrics, **kwargs):
+                    await writer.write_async(chunk, offset)
+                    if hasher:
+                        hasher.update(chunk, offset)
+                        end = max(end, offset + length)
+                    if progress:
+                        downloaded += length
+                        progress(downloaded, size)
+                    if checkpoint:
+                        checkpoint.add(offset, length)
+                        if checkpoint.pending_size >= self.checkpoint_interval:
+                            await writer.flush_async()
+                            checkpoint.flush()
+                if hasher:  # 没能按顺序算到的部分从文件读回来，放到线程池中计算
+                    await writer.flush_async()
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, hasher.finish, size or end, writer.read)
+            except IntegrityError:
+                if checkpoint:  # 数据是错的，不能再续传
+                    checkpoint.remove()
+                raise
+            except BaseException:
+                if checkpoint:
+                    await writer.flush_async()
+                    checkpoint.flush()
+                raise
+        if checkpoint:
+            checkpoint.remove()
+
+    def open_checkpoint(self, url: str, file: str, **kwargs) -> tuple[Optional[Checkpoint], Optional[list[tuple[int, int]]]]:
+        return asyncio.run_coroutine_threadsafe(self.open_checkpoint_async(url, file, **kwargs), self.loop).result()
+
+    async def open_checkpoint_async(self, url: str, file: str, **kwargs) -> tuple[Optional[Checkpoint], Optional[list[tuple[int, int]]]]:
+        """
+        打开文件对应的断点续传记录，如果远程文件的大小、ETag或Last-Modified变了，那么记录就会作废
+        :param url: 下载地址
+        :param file: 保存路径
+        :return: (记录, 还需要下载的范围)，无法续传时记录为None；范围为None代表需要重新下载整个文件
+        """
+        info = await self._probe_fresh(url, **kwargs)  # 缓存的探测结果可能是文件变之前的，要用最新的大小和ETag核对记录
+        content_length = info.content_length
+        if content_length == 0 or not info.accept_ranges:  # 不知道大小或者不支持范围请求就没法续传
+            return None, None
+        etag = info.etag
+        last_modified = info.last_modified
+        path = Checkpoint.for_file(file)
+        checkpoint = Checkpoint.load(path)
+        if checkpoint and checkpoint.matches(url, content_length, etag, last_modified) and os.path.exists(file):
+            checkpoint.compact()
+            return checkpoint, checkpoint.missing_ranges()
+        checkpoint = Checkpoint(path, url, content_length, etag, last_modified)
+        checkpoint.create()
+        return checkpoint, None
+
+    def download(self, url: Sources, ranges: Optional[list[tuple[int, int]]] = None,
+                 metrics: Optional[DownloadMetrics] = None, **kwargs) -> Generator[tuple[bytes, int, int], None, None]:
+        """
+        同步下载，在事件循环线程中下载，通过队列交给当前线程，队列中的数据同样受max_buffer_size限制
+        数据是成批交出的：当前线程已经取完时马上交出，否则攒够sync_batch_size再交出，
+        当前线程处理得慢时，每批只有一次队列加锁和一次归还额度的跨线程调用
+        """
         queue = Queue()
 
         async def enqueue():
-            async for value in self.download_async(url, **kwargs):
-                queue.put(value)
-            queue.put(None)
+            g = self._iter_blocks(url, ranges, metrics=metrics, **kwargs)
+            batch, size = [], 0
+            try:
+                async for value in g:
+                    batch.append(value)
+                    size += value[2]
+                    if size >= self.sync_batch_size or queue.empty():
+                        queue.put((batch, size))
+                        batch, size = [], 0
+                if batch:
+                    queue.put((batch, size))
+                    batch, size = [], 0
+                queue.put(None)
+            except Exception as e:
+                if batch:
+                    queue.put((batch, size))
+                    batch, size = [], 0
+                queue.put(e)
+            finally:
+                if size:  # 被取消时还没交出的数据
+                    self.budget.release(size)
+                await g.aclose()
 
-        asyncio.run_coroutine_threadsafe(enqueue(), self.loop)
-        while True:
-            i = queue.get()
-            if i is None:
-                break
-            yield i
+        def drain():
+            """在事件循环线程中归还队列里没被取走的数据占用的额度"""
+            while not queue.empty():
+                value = queue.get_nowait()
+                if isinstance(value, tuple):
+                    self.budget.release(value[1])
+
+        future = asyncio.run_coroutine_threadsafe(enqueue(), self.loop)
+        try:
+            while True:
+                i = queue.get()
+                if i is None:
+                    break
+                if isinstance(i, Exception):
+                    raise i
+                batch, size = i
+                try:
+                    yield from batch
+                finally:  # 中途退出时这一批剩下的也不要了，一起归还
+                    self.loop.call_soon_threadsafe(self.budget.release, size)
+        finally:
+            if not future.done():
+                future.cancel()
+                self.loop.call_soon_threadsafe(drain)
 
-    async def download_async(self, url: str, **kwargs) -> AsyncGenerator[tuple[bytes, int, int], None]:
+    async def download_async(self, url: Sources, ranges: Optional[list[tuple[int, int]]] = None,
+                             controller: Optional[ConcurrencyController] = None, metrics: Optional[DownloadMetrics] = None,
+                             **kwargs) -> AsyncGenerator[tuple[bytes, int, int], None]:
         """
-        异步下载给定url数据，如果响应头中包含Content-Length，则将数据分成多个任务下载
-        :param url: 下载地址
+        异步下载给定url数据，如果知道文件大小并且服务器支持范围请求，则将数据分成多个任务下载，否则只用一个连接
+        已下载但还没被处理的数据总量受max_buffer_size限制，处理得慢时工作任务会暂停读取
+        :param url: 下载地址，也可以是同一个文件的多个镜像地址，
+            镜像的大小和ETag/Last-Modified要和第一个一致，范围按各个镜像的速度分配，出错或者太慢的镜像会被放弃
+        :param ranges: 只下载这些范围(闭区间)，用于断点续传，None代表下载整个文件
+        :param controller: 自适应并发控制器，传入后会根据速度调整并发数，下载完可以从中读取选定的并发数；
+            不传入且adaptive为True时会自动创建一个
+        :param metrics: 传入后下载的统计会记录在里面，不传入时会自动创建一个，下载过程中可以从self.downloads中找到
         :param kwargs: http_client请求时的其他参数，注意：如果参数中包含headers，那么headers里面不能包含Range字段
         :return: 一个异步生成器
         """
+        g = self._iter_blocks(url, ranges, controller, metrics, **kwargs)
+        try:
+            async for value in g:
+                try:
+                    yield value
+                finally:  # 调用者处理完了，归还额度
+                    self.budget.release(value[2])
+        finally:
+            await g.aclose()
+
+    async def _iter_blocks(self, url: Sources, ranges: Optional[list[tuple[int, int]]] = None,
+                           controller: Optional[ConcurrencyController] = None, metrics: Optional[DownloadMetrics] = None,
+                           **kwargs) -> AsyncGenerator[tuple[bytes, int, int], None]:
+        """download_async的实现，返回的每块数据都占用了self.budget的额度，需要调用者归还"""
         headers = kwargs.get("headers", {})
         assert "Range" not in headers, ValueError("Range header is not allowed")
-        content_length = await self.get_content_length_async(url, **kwargs)
-        if content_length == 0:
-            async for value in self._download(url, None, **kwargs):
-                if value is None:
-                    return
+        urls = [url] if isinstance(url, str) else list(url)
+        url = urls[0]
+        metrics = metrics or DownloadMetrics(url)
+        self.downloads.append(metrics)
+        self._notify("start", metrics)
+        reporter = asyncio.create_task(self._report(metrics))
+        error = None
+        probe = g = None
+        try:
+            if ranges is None:
+                info = await self._probe_fresh(url, **kwargs)
+            else:  # 续传时已经探测过了
+                info = self.probe_cache.get(url) or ResourceInfo(0, True)
+            metrics.size = info.content_length
+            probe = self._probe_responses.pop(url, None)  # 探测请求的响应，从0开始，第一个范围可以直接接着读
+            if ranges is None and (info.content_length == 0 or not info.accept_ranges):
+                if probe is not None and probe[1].status_code != 200:  # 只有开头一部分，没法当作整个文件
+                    await self._discard(probe)
+                    probe = None
+                g = self._iter_single(url, probe, metrics, **kwargs)
+            else:
+                if ranges is None:
+                    ranges = [(0, info.content_length - 1)]
+                if probe is not None and (not ranges or ranges[0][0] != 0):  # 用不上，别占着连接
+                    await self._discard(probe)
+                    probe = None
+                g = self._iter_ranges(await self._check_mirrors(urls, **kwargs), ranges, controller, probe, metrics,
+                                      **kwargs)
+            async for value in g:
+                metrics.first_byte()
+                metrics.buffered = self.budget.used
                 yield value
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if g is not None:
+                await g.aclose()
+            if probe is not None:  # 已经被读完关闭时不会重复关闭
+                await probe[0].aclose()
+            reporter.cancel()
+            metrics.finish(error)
+            self.downloads.remove(metrics)
+            self._notify("finish", metrics)
+
+    async def _report(self, metrics: DownloadMetrics):
+        """定时更新统计并通知observer，速度和卡住的次数只在这里计算，导出统计时只读取"""
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            metrics.buffered = self.budget.used
+            self._notify("update", metrics.update())
+
+    def _notify(self, event: str, metrics: DownloadMetrics):
+        if self.observer is None:
+            return
+        try:
+            self.observer(event, metrics)
+        except Exception:
+            logger.exception("统计回调出错")
+
+    async def _iter_single(self, url: str, probe: Optional[tuple[contextlib.AsyncExitStack, httpx.Response]],
+                           metrics: DownloadMetrics, **kwargs) -> AsyncGenerator[tuple[bytes, int, int], None]:
+        """不分段下载，用于不知道大小或者服务器不支持范围请求时，还没收到数据时出错可以重试"""
+        stats = metrics.worker(0)
+        attempt = 0
+        while True:
+            received = False
+            try:
+                async for value in self._download(url, probe, stats, **kwargs):
+                    if value is None:
+                        return
+                    stats.set_state("backpressure")
+                    await self.budget.acquire(value[2])
+                    received = True
+                    yield value
+                    stats.set_state("receiving")
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if received or delay is None or attempt >= self.max_retries:  # 不支持范围请求时没法从中间继续
+                    raise
+                attempt += 1
+                stats.retries += 1
+                await asyncio.sleep(delay)
+            finally:
+                probe = None
+                stats.set_state("idle")
+
+    async def _check_mirrors(self, urls: list[str], **kwargs) -> list[str]:
+        """探测所有镜像，去掉和主地址不一致或者不支持范围请求的"""
+        if len(urls) == 1:
+            return urls
+        infos = await asyncio.gather(*(self.probe_async(u, **kwargs) for u in urls), return_exceptions=True)
+        if isinstance(infos[0], BaseException):
+            raise infos[0]
+        primary = infos[0]
+        mirrors = urls[:1]
+        for url, info in zip(urls[1:], infos[1:]):
+            if isinstance(info, BaseException):
+                logger.warning("镜像 %s 探测失败，不使用: %r", url, info)
+            elif not info.accept_ranges or info.content_length != primary.content_length:
+                logger.warning("镜像 %s 和 %s 不一致，不使用: %r, %r", url, urls[0], info, primary)
+            elif info.etag and primary.etag and info.etag != primary.etag:
+                logger.warning("镜像 %s 的ETag和 %s 不一致，不使用: %s, %s", url, urls[0], info.etag, primary.etag)
+            elif info.last_modified and primary.last_modified and info.last_modified != primary.last_modified:
+                logger.warning("镜像 %s 的Last-Modified和 %s 不一致，不使用: %s, %s",
+                               url, urls[0], info.last_modified, primary.last_modified)
+            else:
+                mirrors.append(url)
+        return mirrors
+
+    async def _iter_ranges(self, urls: list[str], ranges: list[tuple[int, int]], controller: Optional[ConcurrencyController],
+                           probe: Optional[tuple[contextlib.AsyncExitStack, httpx.Response]], metrics: DownloadMetrics,
+                           **kwargs) -> AsyncGenerator[tuple[bytes, int, int], None]:
+        """分段下载，probe不为空时第一个领到0开始的范围的工作任务直接读取探测请求的响应，有多个镜像时每次请求前选一个"""
+        url = urls[0]
+        content_length = sum(end - start + 1 for start, end in ranges)
+        if content_length == 0:
             return
         # 计算最大下载工作数
         worker_count = content_length // self.worker_min_download_size
         if content_length % self.worker_min_download_size != 0:
             worker_count += 1
-        worker_count = min(worker_count, self.max_workers)
+        multiplexed = all(self._multiplexed(u) for u in urls)
+        worker_count = min(worker_count, self.max_streams * len(urls) if multiplexed else self.max_workers)
+        selector = MirrorSelector(urls)
+        scheduler = RangeScheduler(ranges, worker_count, self.chunk_size, self.worker_min_download_size)
+        if controller is None and self.adaptive:
+            controller = ConcurrencyController(maximum=worker_count)
+        elif controller is not None:
+            controller.maximum = min(controller.maximum, worker_count)
+            controller.concurrency = min(controller.concurrency, controller.maximum)
+        stopped = False  # 下载是否已经结束
+        retries = 0  # 已经重试的次数，所有工作任务共用
+        running = 0  # 正在运行的工作任务数
+        spawned = 0  # 创建过的工作任务数
+
+        def should_retire():
+            """并发数被调低时，多出来的工作任务需要退出"""
+            nonlocal running
+            if controller is not None and running > controller.concurrency:
+                running -= 1
+                return True
+            return False
 
-        async def enqueue(g: AsyncGenerator):
-            """一个简单的将生成器中的值放入队列中的函数"""
+        async def work(stats: WorkerMetrics):
+            """不断领取范围并下载，直到没有范围可以领取，出现暂时性错误时从收到的最后一个字节继续下载"""
+            nonlocal running, retries, probe
             try:
-                async for v in g:
-                    await queue.put(v)
+                retired = False
+                while not retired and not stopped and (segment := scheduler.acquire()) is not None:
+                    try:
+                        attempt = 0
+                        while not retired and segment.position < segment.end:
+                            reuse = None
+                            if probe is not None and segment.position == 0:  # 探测请求是发给主地址的
+                                reuse, probe = probe, None
+                                mirror = selector.use(selector.primary)
+                            else:
+                                mirror = selector.choose()
+                            g = self._download_segment(mirror.url, segment, reuse, stats, **kwargs)
+                            position, started, failed = segment.position, time.monotonic(), False
+                            try:
+                                async for v in g:
+                                    stats.set_state("backpressure")
+                                    await self.budget.acquire(v[2])
+                                    if stopped:  # 取消可能会被http客户端吞掉，这里再检查一次
+                                        self.budget.release(v[2])
+                                        return
+                                    await queue.put(v)
+                                    metrics.queue_depth = queue.qsize()
+                                    stats.set_state("receiving")
+                                    if not retired and should_retire():
+                                        retired = True
+                                        if not self._multiplexed(mirror.url):  # HTTP/2下读完这个流再退出
+                                            break
+                            except Exception as e:
+                                failed = True
+                                delay = self._retry_delay(e, attempt)
+                                if selector.fail(mirror, fatal=delay is None):  # 换一个镜像继续
+                                    logger.warning("%s 镜像出错，不再使用: %r", mirror.url, e)
+                                    continue
+                                if delay is None or retries >= self.max_retries:
+                                    raise
+                                retries += 1
+                                attempt += 1
+                                stats.retries += 1
+                                stats.set_state("idle")
+                                logger.warning("%s 范围%d-%d出错，%.1f秒后从%d继续(第%d次重试): %r",
+                                               mirror.url, segment.start, segment.end - 1, delay, segment.position, retries, e)
+                                await asyncio.sleep(delay)
+                            finally:
+                                await g.aclose()  # 先关闭生成器，更新segment.position之后才能归还
+                                selector.release(mirror, segment.position - position, time.monotonic() - started,
+                                                 not failed)
+                    finally:
+                        scheduler.release(segment)
+                if not retired:
+                    running -= 1
             except Exception as e:
                 await queue.put(e)
+            else:
+                await queue.put(None)
+            finally:
+                stats.set_state("idle")
+
+        def spawn(count: int):
+            nonlocal running, spawned
+            for _ in range(count):
+                tasks.append(asyncio.create_task(work(metrics.worker(spawned))))
+                running += 1
+                spawned += 1
+
+        async def control():
+            """定时统计速度，调整并发数"""
+            while True:
+                await asyncio.sleep(controller.interval)
+                scheduler.worker_count = controller.update()
+                if running < controller.concurrency and not scheduler.finished:
+                    spawn(controller.concurrency - running)
 
+        connection = contextlib.AsyncExitStack()
+        for u in urls:
+            if not self._multiplexed(u):
+                continue
+            # 所有请求共用一个连接，整个下载只占用一个连接数
+            if probe is not None and u == url:
+                # 探测时还不知道是HTTP/2，探测响应已经占了一个连接数，直接留给整个下载，工作任务读完只关闭响应
+                connection.push_async_exit(probe[0])
+                response = probe[1]
+                stack = contextlib.AsyncExitStack()
+                stack.push_async_callback(response.aclose)
+                probe = (stack, response)
+            else:
+                await connection.enter_async_context(self._connection(u, multiplexed=False))
         queue = asyncio.Queue()
-        # 将文件分割成工作任务，并启动异步下载任务
         tasks = []
-        for i in range(worker_count):
-            start = i * content_length // worker_count
-            end = (i + 1) * content_length // worker_count
-            range_ = (start, end-1)
-            task = asyncio.create_task(enqueue(self._download(url, range_, **kwargs)))
-            tasks.append(task)
-        # 等待所有异步下载任务完成
-        over_count = 0
-        while worker_count != over_count:
-            get = await queue.get()
-            if get is None:
-                over_count += 1
-            elif isinstance(get, Exception):
-                raise get
-            else:
-                yield get
+        # 启动异步下载任务，每个任务都从调度器领取要下载的范围
+        if controller is None:
+            spawn(worker_count)
+        else:
+            spawn(controller.concurrency)
+            tasks.append(asyncio.create_task(control()))
+        try:
+            # 等待所有异步下载任务完成
+            over_count = 0
+            while spawned != over_count:
+                get = await queue.get()
+                if get is None:
+                    over_count += 1
+                elif isinstance(get, Exception):
+                    raise get
+                else:
+                    if controller is not None:
+                        controller.feed(get[2])
+                    metrics.queue_depth = queue.qsize()
+                    yield get
+            if not scheduler.finished:
+                raise RuntimeError("下载任务提前结束，还有数据没有下载")
+        finally:
+            stopped = True
+            for task in tasks:
+                task.cancel()
+            while not queue.empty():  # 没被取走的数据也要归还额度
+                get = queue.get_nowait()
+                if isinstance(get, tuple):
+                    self.budget.release(get[2])
+            await connection.aclose()
+        if len(urls) > 1:
+            logger.info("%s 镜像: %s", url, selector.mirrors)
+        if controller is not None:
+            logger.info("%s 自适应并发数: %d (最快 %d, %.1fKB/s)",
+                        url, controller.concurrency, controller.best_concurrency, controller.best_speed / 1024)
+
+    def _retry_delay(self, e: Exception, attempt: int) -> Optional[float]:
+        """判断错误是否可以重试，可以时返回需要等待的秒数"""
+        if isinstance(e, httpx.HTTPStatusError):
+            status = e.response.status_code
+            if status not in (408, 429) and status < 500:
+                return None
+            retry_after = self._parse_retry_after(e.response.headers.get("Retry-After"))
+            if retry_after is not None:
+                return min(retry_after, self.retry_max_delay)
+        elif not isinstance(e, (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError, IncompleteReadError)):
+            return None
+        # 指数退避，加上随机抖动，避免所有工作任务同时重试
+        delay = min(self.retry_max_delay, self.retry_backoff * 2 ** attempt)
+        return delay * random.uniform(0.5, 1)
+
+    @staticmethod
+    def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """Retry-After可能是秒数，也可能是一个http日期"""
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max((date - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
 
     def get_content_length(self, url: str, **kwargs):
         content_length = asyncio.run_coroutine_threadsafe(self.get_content_length_async(url, **kwargs), self.loop).result()
         return content_length
 
     async def get_content_length_async(self, url: str, **kwargs):
+        return (await self.probe_async(url, **kwargs)).content_length
+
+    def probe(self, url: str, reuse=False, **kwargs) -> ResourceInfo:
+        return asyncio.run_coroutine_threadsafe(self.probe_async(url, reuse, **kwargs), self.loop).result()
+
+    async def probe_async(self, url: str, reuse=False, **kwargs) -> ResourceInfo:
+        """
+        探测远程文件的大小、是否支持范围请求和校验信息，结果按url缓存
+        不用head请求(有些服务器不支持)，而是请求开头的worker_min_download_size字节，只读响应头；
+        范围有上限，用不上的响应直接关闭时服务器也不会白白发送整个文件，不过HTTP/1.1下这个连接就不能复用了
+        :param reuse: 把探测请求的响应留给接下来这个url的下载，第一个范围直接接着读，省掉一次请求
+        """
+        info = self.probe_cache.get(url)
+        if info is not None:
+            return info
+        stack, response = await self._open_probe(url, **kwargs)
         try:
-            headers = (await self.http_client.head(url, **kwargs)).headers
-            content_length = int(headers.get("Content-Length", 0))
-        except KeyError:
-            content_length = 0
-        return content_length
+            if response.status_code == 416:  # 空文件
+                info = ResourceInfo(0, False)
+            else:
+                info = ResourceInfo(0, response.status_code == 206, response.headers.get("ETag", ""),
+                                    response.headers.get("Last-Modified", ""), response.http_version)
+                if info.accept_ranges:
+                    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+                    info.content_length = int(total) if total.isdigit() else 0
+                else:  # 服务器忽略了Range，返回的是整个文件
+                    info.content_length = int(response.headers.get("Content-Length", 0))
+                if response.headers.get("Content-Encoding", "identity") != "identity":  # 压缩后的大小和文件大小对不上，没法分段
+                    info.content_length, info.accept_ranges = 0, False
+        except BaseException:
+            await stack.aclose()
+            raise
+        self.probe_cache[url] = info
+        if reuse and response.status_code in (200, 206):
+            old = self._probe_responses.pop(url, None)
+            if old is not None:
+                await old[0].aclose()
+            self._probe_responses[url] = (stack, response)
+        else:
+            await self._discard((stack, response))
+        return info
+
+    async def _probe_fresh(self, url: str, **kwargs) -> ResourceInfo:
+        """
+        每次下载开始前拿到最新的探测结果，并把响应留给下载；文件可能已经变了，缓存的结果不能直接用，
+        只有刚探测过(响应还留着没用)时才不用再探测，比如save_async续传时先探测再下载
+        """
+        if url not in self._probe_responses:
+            self.probe_cache.pop(url, None)
+        return await self.probe_async(url, reuse=True, **kwargs)
+
+    async def _open_probe(self, url: str, **kwargs) -> tuple[contextlib.AsyncExitStack, httpx.Response]:
+        """发送探测请求，超时、连接断开、5xx、429等错误和范围下载一样退避重试，最多probe_retries次"""
+        attempt = 0
+        while True:
+            stack = contextlib.AsyncExitStack()
+            try:
+                response = await self._open_range(stack, url, 0, self.worker_min_download_size - 1, **kwargs)
+                if response.status_code != 416:
+                    response.raise_for_status()
+                return stack, response
+            except Exception as e:
+                await stack.aclose()
+                delay = self._retry_delay(e, attempt)
+                if delay is None or attempt >= self.probe_retries:
+                    raise
+                attempt += 1
+                logger.warning("%s 探测出错，%.1f秒后重试(第%d次): %r", url, delay, attempt, e)
+                await asyncio.sleep(delay)
+            except BaseException:
+                await stack.aclose()
+                raise
+
+    async def _open_range(self, stack: contextlib.AsyncExitStack, url: str, start: int, end: Optional[int] = None,
+                          **kwargs) -> httpx.Response:
+        """占用一个连接，发送范围请求，连接和响应由stack负责关闭"""
+        kwargs["headers"] = {**kwargs.get("headers", {}), "Range": f"bytes={start}-{'' if end is None else end}"}
+        await stack.enter_async_context(self._connection(url))
+        return await stack.enter_async_context(self.http_client.stream("GET", url, **kwargs))
+
+    def _check_range(self, url: str, response: httpx.Response, start: int):
+        """检查响应是不是请求的范围，文件变了的话缓存的探测结果也要作废"""
+        response.raise_for_status()
+        info = self.probe_cache.get(url)
+        etag = response.headers.get("ETag", "")
+        if info is not None and info.etag and etag and etag != info.etag:
+            self.probe_cache.pop(url, None)
+            raise RangeError(f"{url} 文件在下载过程中变了: ETag {info.etag} -> {etag}")
+        if response.status_code != 206 and start != 0:
+            self.probe_cache.pop(url, None)
+            raise RangeError(f"{url} 服务器没有返回请求的范围，状态码{response.status_code}")
+        total = response.headers.get("Content-Range", "").rpartition("/")[2]
+        if info is not None and info.content_length and total.isdigit() and int(total) != info.content_length:
+            self.probe_cache.pop(url, None)  # 没有ETag时只能靠大小发现文件变了
+            raise RangeError(f"{url} 文件在下载过程中变了: 大小 {info.content_length} -> {total}")
+
+    async def _discard(self, probe: tuple[contextlib.AsyncExitStack, httpx.Response]):
+        """关闭用不上的探测响应，HTTP/2下需要先读完，原因见_download_segment"""
+        try:
+            if probe[1].http_version == "HTTP/2" and probe[1].status_code == 206:
+                await probe[1].aread()
+        finally:
+            await probe[0].aclose()
+
+    async def _throttle(self, size: int, stats: Optional[WorkerMetrics]):
+        if not self.rate_limiter:
+            return
+        if stats:
+            stats.set_state("throttled")
+        await self.rate_limiter.consume(size)
+        if stats:
+            stats.set_state("receiving")
 
-    async def _download(self, url: str, range_: Optional[tuple[int, int]], **kwargs) -> AsyncGenerator[Optional[tuple[bytes, int, int]], None]:
+    def _multiplexed(self, url: str) -> bool:
+        info = self.probe_cache.get(url)
+        return info is not None and info.multiplexed
+
+    @contextlib.asynccontextmanager
+    async def _connection(self, url: str, multiplexed: Optional[bool] = None):
+        """
+        有连接数限制时，先占用一个连接再发请求
+        :param multiplexed: 是否是HTTP/2，是的话不单独占用，None代表根据探测结果判断
+        """
+        if multiplexed is None:
+            multiplexed = self._multiplexed(url)
+        if self.limiter is None or multiplexed:
+            yield
+            return
+        async with self.limiter.connection(urlparse(url).netloc, self):
+            yield
+
+    async def _download(self, url: str, probe: Optional[tuple[contextlib.AsyncExitStack, httpx.Response]] = None,
+                        stats: Optional[WorkerMetrics] = None, **kwargs) -> AsyncGenerator[Optional[tuple[bytes, int, int]], None]:
+        """不分段下载，用于不知道文件大小或者服务器不支持范围请求时，probe不为空时直接读取探测请求的响应"""
         offset = 0
-        if range_:
-            headers = kwargs.setdefault("headers", {})
-            headers["Range"] = f"bytes={range_[0]}-{range_[1]}"
-            offset = range_[0]
-        async with self.http_client.stream("GET", url, **kwargs) as response:
-            async for chunk in response.aiter_bytes(1024):
+        if stats:
+            stats.request_started(url)
+        async with contextlib.AsyncExitStack() as stack:
+            if probe is None:
+                await stack.enter_async_context(self._connection(url))
+                response = await stack.enter_async_context(self.http_client.stream("GET", url, **kwargs))
+            else:
+                stack.push_async_exit(probe[0])
+                response = probe[1]
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(self.block_size):
+                if stats:
+                    stats.received(len(chunk))
+                await self._throttle(len(chunk), stats)
                 length = len(chunk)
                 yield chunk, offset, length
                 offset += length
         yield None
 
+    async def _download_segment(self, url: str, segment: Segment,
+                                probe: Optional[tuple[contextlib.AsyncExitStack, httpx.Response]] = None,
+                                stats: Optional[WorkerMetrics] = None, **kwargs) -> AsyncGenerator[tuple[bytes, int, int], None]:
+        """
+        下载一个范围，segment.end被缩短后会提前结束，响应只包含一部分时(比如探测请求)读完这部分就结束
+        网络上收到的小块数据会先拷贝到缓冲区，攒够block_size再交给调用者，减少队列操作次数
+        HTTP/2下每次最多请求worker_min_download_size，并且每个流都要读完：
+        httpx关闭没读完的流时不会通知服务器，服务器继续发来的数据会一直占着连接的流量控制窗口，最后整个连接都会卡住
+        :param probe: 探测请求的响应，segment从0开始时可以直接接着读，不用再发请求
+        :param stats: 记录这个工作任务的统计
+        """
+        if stats:
+            stats.request_started(url)
+        multiplexed = self._multiplexed(url)
+        request_end = segment.end
+        if multiplexed:
+            request_end = min(segment.end, segment.position + self.worker_min_download_size)
+        block_size = self.block_size
+        buffer = bytearray(block_size)  # 同一个范围内重复使用
+        filled = 0
+        offset = segment.position  # 缓冲区开头对应的文件位置
+        delivered = offset  # 已经交出去的数据的结束位置
+        try:
+            async with contextlib.AsyncExitStack() as stack:
+                if probe is None:
+                    response = await self._open_range(stack, url, segment.position, request_end - 1, **kwargs)
+                else:
+                    stack.push_async_exit(probe[0])
+                    response = probe[1]
+                self._check_range(url, response, segment.position)
+                content_range = re.fullmatch(r"bytes \d+-(\d+)/.*", response.headers.get("Content-Range", ""))
+                if content_range:
+                    request_end = int(content_range[1]) + 1
+                async for data in response.aiter_bytes():
+                    if stats:
+                        stats.received(len(data))
+                    await self._throttle(len(data), stats)
+                    length = min(len(data), segment.end - segment.position)
+                    if length <= 0:
+                        if multiplexed:  # 范围被分走了，多出来的数据丢掉
+                            continue
+                        break
+                    segment.position += length
+                    view = memoryview(data)[:length]
+                    while view:
+                        if filled == 0 and len(view) >= block_size:  # 收到的数据够大，不需要经过缓冲区
+                            delivered = offset + block_size
+                            yield bytes(view[:block_size]), offset, block_size
+                            view = view[block_size:]
+                            offset += block_size
+                            continue
+                        n = min(len(view), block_size - filled)
+                        buffer[filled:filled + n] = view[:n]
+                        view = view[n:]
+                        filled += n
+                        if filled == block_size:
+                            delivered = offset + block_size
+                            yield bytes(buffer), offset, block_size
+                            offset += block_size
+                            filled = 0
+                    if segment.position >= segment.end and not multiplexed:
+                        break
+                else:
+                    if segment.position < min(segment.end, request_end):  # 服务器没发完就结束了
+                        raise IncompleteReadError(f"范围{segment.start}-{segment.end - 1}只收到了{segment.position - segment.start}字节")
+            if filled:
+                delivered = offset + filled
+                yield bytes(buffer[:filled]), offset, filled
+        except Exception:
+            if filled and delivered < offset + filled:  # 出错时已经收到的数据也交出去，重试时不用再下载
+                delivered = offset + filled
+                yield bytes(buffer[:filled]), offset, filled
+            raise
+        finally:
+            # 被提前关闭时缓冲区里还没交出去的数据需要重新下载
+            segment.position = min(segment.position, delivered)
+
 
 async def main():
     import colorama
+    from FakeServer import FakeServer
     colorama.init(autoreset=True)
-    async with Downloader(loop=asyncio.get_event_loop(), max_workers=3) as downloader:
-        u1 = "http://127.0.0.1/LocalSend.exe"
-        u2 = "http://127.0.0.1/ShareMouseSetup.exe"
+    async with Downloader(loop=asyncio.get_event_loop(), max_workers=3) as downloader, \
+            FakeServer(size=8 * 1024 * 1024, bandwidth=2 * 1024 * 1024) as s1, \
+            FakeServer(size=4 * 1024 * 1024, bandwidth=1024 * 1024, drop_rate=0.2) as s2:
+        u1 = s1.url
+        u2 = s2.url
 
         size1, size2 = await asyncio.gather(
             downloader.get_content_length_async(u1),
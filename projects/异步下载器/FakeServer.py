@@ -0,0 +1,177 @@
+"""
+本地测试用的http服务器，只依赖标准库，用来测试和衡量下载器
+- 支持GET、HEAD、Range和If-None-Match，任意路径返回同一份数据
+- 可以模拟首字节延迟、每个连接的带宽上限、随机断开连接、不支持Range的服务器
+python FakeServer.py --size 67108864 --port 8765 --latency 0.01 --bandwidth 1048576 --drop-rate 0.1 --ignore-range
+"""
+import argparse
+import asyncio
+import os
+import random
+import re
+import time
+from typing import Optional
+
+
+class FakeServer:
+    """
+    可以在当前事件循环中使用：
+        async with FakeServer(size=1024 * 1024, latency=0.01) as server:
+            await downloader.get_async(server.url)
+    也可以用run_server在子进程中运行，避免服务器的CPU占用算到下载器头上
+    """
+    ETAG = '"fake"'
+    LAST_MODIFIED = "Mon, 01 Jan 2024 00:00:00 GMT"
+
+    def __init__(self, data: Optional[bytes] = None, size: int = 16 * 1024 * 1024, host: str = "127.0.0.1", port: int = 0,
+                 latency: float = 0.0, bandwidth: float = 0, drop_rate: float = 0.0, ignore_range=False,
+                 write_size: int = 64 * 1024, seed: Optional[int] = None):
+        """
+        :param data: 返回的数据，为None时生成size字节的随机数据
+        :param port: 为0时随机选一个空闲端口，start后从port属性读取
+        :param latency: 每个请求发送响应头之前等待的秒数
+        :param bandwidth: 每个连接的速度上限，字节/秒，0代表不限速
+        :param drop_rate: 每个响应在发送到中途时断开连接的概率
+        :param ignore_range: 忽略Range，总是返回整个文件，模拟不支持范围请求的服务器
+        :param write_size: 每次发送多少数据
+        :param seed: 断开连接的随机数种子，用来复现
+        """
+        self.data = os.urandom(size) if data is None else data
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drop_rate = drop_rate
+        self.ignore_range = ignore_range
+        self.write_size = write_size
+        self.random = random.Random(seed)
+        # 统计
+        self.connections = 0
+        self.requests = 0
+        self.bytes_sent = 0
+        self.drops = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/fake.bin"
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        """处理一个请求，返回连接是否还能继续用"""
+        request_line = await reader.readline()
+        if not request_line:
+            return False
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line.strip():
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        self.requests += 1
+        method = request_line.split(b" ", 1)[0].decode("latin-1").upper()
+        keep_alive = headers.get("connection", "").lower() != "close"
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        size = len(self.data)
+        status, start, end = "200 OK", 0, size - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", headers.get("range", ""))
+        if headers.get("if-none-match") == self.ETAG:
+            status, start, end = "304 Not Modified", 0, -1
+        elif match and not self.ignore_range:
+            start = int(match[1])
+            if start >= size:
+                status, start, end = "416 Range Not Satisfiable", 0, -1
+            else:
+                status, end = "206 Partial Content", min(int(match[2]), end) if match[2] else end
+        lines = [f"HTTP/1.1 {status}", f"Content-Length: {end - start + 1 if status[0] == '2' else 0}",
+                 "Accept-Ranges: none" if self.ignore_range else "Accept-Ranges: bytes",
+                 f"ETag: {self.ETAG}", f"Last-Modified: {self.LAST_MODIFIED}"]
+        if status.startswith("206"):
+            lines.append(f"Content-Range: bytes {start}-{end}/{size}")
+        elif status.startswith("416"):
+            lines.append(f"Content-Range: bytes */{size}")
+        if not keep_alive:
+            lines.append("Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if method == "HEAD" or not status.startswith("2"):
+            await writer.drain()
+            return keep_alive
+
+        # 决定这个响应要不要在中途断开
+        drop_at = end + 1
+        if self.drop_rate and end - start + 1 > self.write_size and self.random.random() < self.drop_rate:
+            drop_at = self.random.randint(start + 1, end)
+        view = memoryview(self.data)
+        began = time.monotonic()
+        position = start
+        while position <= end:
+            length = min(self.write_size, end + 1 - position, drop_at - position)
+            if length <= 0:
+                self.drops += 1
+                return False
+            writer.write(view[position:position + length])
+            await writer.drain()
+            position += length
+            self.bytes_sent += length
+            if self.bandwidth:  # 按总量控制速度，不会因为每次sleep的误差越来越慢
+                delay = began + (position - start) / self.bandwidth - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        return keep_alive
+
+
+def run_server(**options):
+    """在当前进程中一直运行，用于multiprocessing.Process(target=run_server, kwargs=...)，需要指定port"""
+    asyncio.run(FakeServer(**options).serve_forever())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地测试用的http服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--size", type=int, default=16 * 1024 * 1024, help="文件大小")
+    parser.add_argument("--latency", type=float, default=0.0, help="每个请求的首字节延迟，秒")
+    parser.add_argument("--bandwidth", type=float, default=0, help="每个连接的速度上限，字节/秒")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="响应中途断开连接的概率")
+    parser.add_argument("--ignore-range", action="store_true", help="忽略Range，总是返回整个文件")
+    args = parser.parse_args()
+    print(f"http://{args.host}:{args.port}/fake.bin", flush=True)
+    run_server(**vars(args))
+
+
+if __name__ == '__main__':
+    main()
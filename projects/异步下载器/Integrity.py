@@ -0,0 +1,110 @@
+import hashlib
+from typing import Optional, Callable
+
+
+class IntegrityError(ValueError):
+    """下载的数据和期望的摘要不一致"""
+
+
+def parse_checksum(checksum: str) -> tuple[str, str]:
+    """把"算法:摘要"拆开，返回(算法, 小写摘要)，省略算法时是sha256"""
+    algorithm, _, digest = checksum.rpartition(":")
+    return (algorithm or "sha256").lower(), digest.lower()
+
+
+class StreamHasher:
+    """
+    边下载边计算摘要
+    多个范围的数据是乱序到达的，摘要只能按顺序计算，所以维护一个"前沿"位置：
+    - 刚好接在前沿后面的数据直接计算，然后把之前暂存的、能接上的数据也算掉
+    - 其他数据先暂存在内存中，超过max_pending后不再暂存，最后从文件中读回来(大概率还在系统缓存里)
+    """
+
+    def __init__(self, algorithm: str = "sha256", expected: str = "", max_pending: int = 64 * 1024 * 1024,
+                 block_size: int = 0, block_digests: Optional[list[str]] = None):
+        """
+        :param algorithm: hashlib支持的算法名，比如sha256、md5
+        :param expected: 期望的十六进制摘要，为空时只计算不校验
+        :param max_pending: 最多暂存多少乱序数据
+        :param block_size: 分块校验时每块的大小
+        :param block_digests: 每块的期望摘要(同一个算法)，前沿经过一块时就校验，能在下载中途发现损坏
+        """
+        self.algorithm = algorithm
+        self.expected = expected.lower()
+        self.max_pending = max_pending
+        self.block_size = block_size
+        self.block_digests = [d.lower() for d in block_digests or []]
+        self.frontier = 0
+        self._hash = hashlib.new(algorithm)
+        self._block_hash = hashlib.new(algorithm) if self.block_digests else None
+        self._pending: dict[int, bytes] = {}
+        self._pending_size = 0
+
+    @classmethod
+    def from_checksum(cls, checksum: str, **kwargs) -> "StreamHasher":
+        """从"算法:摘要"格式创建"""
+        algorithm, digest = parse_checksum(checksum)
+        return cls(algorithm, digest, **kwargs)
+
+    @property
+    def pending_size(self) -> int:
+        return self._pending_size
+
+    def update(self, chunk: bytes, offset: int):
+        if offset == self.frontier:
+            self._consume(chunk)
+            while self.frontier in self._pending:
+                chunk = self._pending.pop(self.frontier)
+                self._pending_size -= len(chunk)
+                self._consume(chunk)
+        elif offset > self.frontier and self._pending_size + len(chunk) <= self.max_pending:
+            self._pending[offset] = chunk
+            self._pending_size += len(chunk)
+        # 其他情况(重复的数据或者暂存满了)在finish时从文件读取
+
+    def finish(self, size: int, read: Callable[[int, int], bytes], read_size: int = 1024 * 1024) -> str:
+        """
+        把前沿之后的数据算完，返回十六进制摘要，和期望不一致时抛出IntegrityError
+        :param size: 文件大小
+        :param read: 读取文件的函数，参数是(位置, 大小)
+        """
+        pending = sorted(self._pending.items())
+        self._pending.clear()
+        self._pending_size = 0
+        for offset, chunk in pending + [(size, b"")]:
+            while self.frontier < min(offset, size):  # 没暂存的部分从文件读
+                data = read(self.frontier, min(read_size, offset - self.frontier))
+                if not data:
+                    raise IntegrityError(f"文件在{self.frontier}处提前结束")
+                self._consume(data)
+            if offset + len(chunk) > self.frontier:
+                self._consume(chunk[self.frontier - offset:])
+        if self._block_hash is not None and self.frontier % self.block_size:  # 最后不满一块的部分
+            self._check_block()
+        digest = self._hash.hexdigest()
+        if self.expected and digest != self.expected:
+            raise IntegrityError(f"{self.algorithm}校验失败: 期望{self.expected}, 实际{digest}")
+        return digest
+
+    def _consume(self, chunk: bytes):
+        if self._block_hash is None:
+            self._hash.update(chunk)
+            self.frontier += len(chunk)
+            return
+        view = memoryview(chunk)
+        while view:
+            n = min(len(view), self.block_size - self.frontier % self.block_size)
+            self._hash.update(view[:n])
+            self._block_hash.update(view[:n])
+            self.frontier += n
+            view = view[n:]
+            if self.frontier % self.block_size == 0:
+                self._check_block()
+
+    def _check_block(self):
+        index = (self.frontier - 1) // self.block_size
+        digest = self._block_hash.hexdigest()
+        self._block_hash = hashlib.new(self.algorithm)
+        if index < len(self.block_digests) and digest != self.block_digests[index]:
+            start = index * self.block_size
+            raise IntegrityError(f"第{index}块({start}-{min(start + self.block_size, self.frontier) - 1})校验失败")
@@ -0,0 +1,243 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import Optional, Callable, Union
+
+import httpx
+from httpx import AsyncClient
+
+from Downloader import Downloader
+from Metrics import DownloadMetrics
+from Scheduler import ConnectionLimiter, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadJob:
+    """下载管理器中的一个下载项"""
+    WAITING = "waiting"
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, url: Union[str, list[str]], path: str, priority: int = 0, proxy: str = "", **kwargs):
+        """
+        :param url: 下载地址，也可以是同一个文件的多个镜像地址
+        :param path: 保存路径
+        :param priority: 优先级，越大越先开始，同时下载时也优先分配连接
+        :param proxy: 代理地址
+        :param kwargs: 传给Downloader.save_async的其他参数
+        """
+        self.url = url
+        self.path = path
+        self.priority = priority
+        self.proxy = proxy
+        self.kwargs = kwargs
+        self.state = self.WAITING
+        self.file_size = -1  # -1代表还没开始，0代表未知
+        self.download_size = 0
+        self.on_progress: Optional[Callable[[int, int], None]] = None  # 进度回调，参数同save_async的progress，在事件循环线程中调用
+        self.error: Optional[BaseException] = None
+        self.metrics: Optional[DownloadMetrics] = None  # 开始下载后才有
+        self.task: Optional[asyncio.Task] = None
+        self._done: Optional[asyncio.Event] = None  # 在事件循环线程中创建
+        self._callbacks: list[Callable[["DownloadJob"], None]] = []
+
+    @property
+    def done(self) -> bool:
+        return self.state in (self.FINISHED, self.FAILED, self.CANCELLED)
+
+    def add_done_callback(self, callback: Callable[["DownloadJob"], None]):
+        """下载结束(完成、失败、取消)时在事件循环线程中调用"""
+        if self.done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    async def wait(self):
+        """等待下载结束，失败时抛出异常"""
+        if not self.done:
+            if self._done is None:
+                self._done = asyncio.Event()
+            await self._done.wait()
+        if self.error is not None:
+            raise self.error
+
+    def _finish(self, state: str, error: Optional[BaseException] = None):
+        self.state = state
+        self.error = error
+        if self._done is not None:
+            self._done.set()
+        for callback in self._callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception("下载回调出错")
+        self._callbacks.clear()
+
+    def __repr__(self):
+        return f"DownloadJob({self.url!r}, {self.state}, {self.download_size}/{self.file_size})"
+
+
+class DownloadManager:
+    """
+    下载管理器，所有下载共用连接池、连接数限制和限速
+    - 同时最多进行max_downloads个下载，其他的按优先级排队
+    - 总连接数和每个主机的连接数有上限，连接平均分给正在进行的下载
+    - 可以设置总速度上限
+    下载会启用断点续传，取消后再次添加同一个路径会接着下载
+    """
+
+    def __init__(self,
+                 max_downloads: int = 4,
+                 max_connections: int = 32,
+                 max_connections_per_host: int = 8,
+                 rate_limit: float = 0,
+                 http2=False,
+                 loop: Optional[asyncio.AbstractEventLoop] = None,
+                 **downloader_options):
+        """
+        :param max_downloads: 同时进行的下载数
+        :param max_connections: 所有下载的总连接数
+        :param max_connections_per_host: 每个主机的连接数
+        :param rate_limit: 总速度上限，字节/秒，0代表不限速
+        :param http2: 是否启用HTTP/2(需要安装h2)，服务器支持时一个文件的所有范围共用一个连接
+        :param loop: 事件循环，可以在其他线程中运行，add和cancel是线程安全的
+        :param downloader_options: 创建Downloader时的其他参数，比如max_workers
+        """
+        self.loop = loop or asyncio.get_event_loop()
+        self.max_downloads = max_downloads
+        self.max_connections = max_connections
+        self.http2 = http2
+        self.limiter = ConnectionLimiter(max_connections, max_connections_per_host)
+        self.rate_limiter = TokenBucket(rate_limit)
+        self.downloader_options = downloader_options
+        self.probe_cache = {}  # 所有下载器共用，断点续传前会重新探测，不会拿过期的结果核对记录
+        self.jobs: list[DownloadJob] = []
+        self._queue: list[tuple[int, int, DownloadJob]] = []  # (-优先级, 序号, 下载项)
+        self._counter = itertools.count()
+        self._running: set[DownloadJob] = set()
+        self._clients: dict[str, AsyncClient] = {}  # 代理->http客户端
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close_async()
+
+    @property
+    def metrics(self) -> list[DownloadMetrics]:
+        """正在进行的下载的统计，可以用Metrics.render_prometheus导出"""
+        return [job.metrics for job in self._running if job.metrics is not None]
+
+    @property
+    def rate_limit(self) -> float:
+        return self.rate_limiter.rate
+
+    @rate_limit.setter
+    def rate_limit(self, value: float):
+        self.rate_limiter.rate = value
+        self.rate_limiter.burst = value
+
+    def add(self, url: Union[str, list[str]], path: str, priority: int = 0, proxy: str = "",
+            on_done: Optional[Callable[[DownloadJob], None]] = None,
+            on_progress: Optional[Callable[[int, int], None]] = None, **kwargs) -> DownloadJob:
+        """
+        添加下载，可以在任意线程中调用
+        :param on_done: 下载结束时的回调，在事件循环线程中调用
+        :param on_progress: 进度回调，参数是(已下载大小, 文件大小)，在事件循环线程中调用，每收到一块数据调用一次，要尽量快
+        其他参数见DownloadJob
+        """
+        job = DownloadJob(url, path, priority, proxy, **kwargs)
+        job.on_progress = on_progress
+        if on_done is not None:
+            job.add_done_callback(on_done)
+        self.loop.call_soon_threadsafe(self._enqueue, job)
+        return job
+
+    def cancel(self, job: DownloadJob):
+        """取消下载，可以在任意线程中调用，已下载的部分会保留，下次添加时接着下载"""
+        self.loop.call_soon_threadsafe(self._cancel, job)
+
+    async def join(self):
+        """等待所有已添加的下载结束"""
+        await asyncio.sleep(0)  # 让其他线程中add的下载先进入队列
+        while not all(job.done for job in self.jobs):
+            await asyncio.gather(*(job.wait() for job in self.jobs), return_exceptions=True)
+
+    async def close_async(self):
+        for job in self.jobs:
+            self._cancel(job)
+        tasks = [job.task for job in self.jobs if job.task is not None]
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+    def close(self):
+        """在其他线程中关闭，会等待关闭完成"""
+        asyncio.run_coroutine_threadsafe(self.close_async(), self.loop).result()
+
+    def _client(self, proxy: str) -> AsyncClient:
+        client = self._clients.get(proxy)
+        if client is None:
+            limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+            client = AsyncClient(proxy=proxy or None, timeout=50, verify=False, limits=limits, http2=self.http2)
+            self._clients[proxy] = client
+        return client
+
+    def _enqueue(self, job: DownloadJob):
+        self.jobs.append(job)
+        heapq.heappush(self._queue, (-job.priority, next(self._counter), job))
+        self._dispatch()
+
+    def _cancel(self, job: DownloadJob):
+        if job.done:
+            return
+        if job.task is not None:
+            job.task.cancel()
+        else:
+            job._finish(DownloadJob.CANCELLED)
+
+    def _dispatch(self):
+        """还有空位时，按优先级开始下载"""
+        while self._queue and len(self._running) < self.max_downloads:
+            _, _, job = heapq.heappop(self._queue)
+            if job.done:  # 排队时被取消了
+                continue
+            job.state = DownloadJob.RUNNING
+            self._running.add(job)
+            job.task = self.loop.create_task(self._run(job))
+
+    async def _run(self, job: DownloadJob):
+        def progress(download_size, file_size):
+            job.download_size = download_size
+            job.file_size = file_size
+            if job.on_progress is not None:
+                job.on_progress(download_size, file_size)
+
+        job.metrics = DownloadMetrics(job.url if isinstance(job.url, str) else job.url[0])
+        downloader = None
+        try:
+            # 创建客户端也可能出错(比如启用了HTTP/2但没安装h2)，要放在try里面，不然下载项会一直是RUNNING
+            downloader = Downloader(http_client=self._client(job.proxy), loop=self.loop,
+                                    limiter=self.limiter, rate_limiter=self.rate_limiter, probe_cache=self.probe_cache,
+                                    **self.downloader_options)
+            self.limiter.priorities[downloader] = job.priority
+            kwargs = {"follow_redirects": True, **job.kwargs}
+            await downloader.save_async(job.url, job.path, resume=True, progress=progress, metrics=job.metrics, **kwargs)
+        except asyncio.CancelledError:
+            job._finish(DownloadJob.CANCELLED)
+        except Exception as e:
+            logger.warning("%s 下载失败: %r", job.url, e)
+            job._finish(DownloadJob.FAILED, e)
+        else:
+            job._finish(DownloadJob.FINISHED)
+        finally:
+            if downloader is not None:
+                self.limiter.priorities.pop(downloader, None)
+                await downloader.release_probes_async()  # 客户端是共用的，不能关闭，只关闭没用上的探测响应
+            self._running.discard(job)
+            self._dispatch()
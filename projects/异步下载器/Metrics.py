@@ -0,0 +1,263 @@
+"""
+下载的统计信息，用来判断下载慢是因为网络、服务器还是磁盘
+- 每个下载一个DownloadMetrics，每个工作任务一个WorkerMetrics
+- 工作任务的时间按状态累计：connecting(等连接和响应头，慢说明服务器慢)、receiving(收数据，慢说明网络慢)、
+  throttled(被限速)、backpressure(等调用者处理，慢说明磁盘或者调用者慢)
+- 可以导出为json或者Prometheus的文本格式
+"""
+import asyncio
+import json
+import time
+from typing import Optional, Callable, Iterable
+
+
+class WorkerMetrics:
+    """一个工作任务的统计"""
+    STATES = ("idle", "connecting", "receiving", "throttled", "backpressure")
+
+    def __init__(self, index: int):
+        self.index = index
+        self.url = ""  # 最近一次请求的地址，有多个镜像时会变
+        self.bytes = 0
+        self.requests = 0
+        self.retries = 0
+        self.stalls = 0
+        self.stalled = False
+        self.ttfb = 0.0  # 最近一次请求的首字节时间，秒
+        self.speed = 0.0  # 最近一个统计间隔的速度，字节/秒
+        self.ema_speed = 0.0
+        self.state = "idle"
+        self.state_time = dict.fromkeys(self.STATES, 0.0)  # 每个状态累计的秒数
+        self._state_since = time.monotonic()
+        self._request_at = 0.0
+        self._last_data = self._state_since
+        self._last_bytes = 0
+
+    def set_state(self, state: str):
+        now = time.monotonic()
+        self.state_time[self.state] += now - self._state_since
+        self.state = state
+        self._state_since = now
+
+    def request_started(self, url: str):
+        self.url = url
+        self.requests += 1
+        self.set_state("connecting")
+        self._request_at = self._last_data = self._state_since
+
+    def received(self, size: int):
+        """收到网络数据，第一次收到时记录首字节时间"""
+        now = time.monotonic()
+        if self.state == "connecting":
+            self.ttfb = now - self._request_at
+            self.set_state("receiving")
+        self.bytes += size
+        self._last_data = now
+        self.stalled = False
+
+    def update(self, interval: float, alpha: float, stall_timeout: float):
+        """每个统计间隔调用一次，计算速度，检查是否卡住"""
+        now = time.monotonic()
+        self.speed = (self.bytes - self._last_bytes) / interval if interval > 0 else 0.0
+        self._last_bytes = self.bytes
+        self.ema_speed = self.speed if not self.ema_speed else self.ema_speed * (1 - alpha) + self.speed * alpha
+        waiting = self.state in ("connecting", "receiving")
+        if waiting and not self.stalled and now - self._last_data > stall_timeout:
+            self.stalled = True
+            self.stalls += 1
+        # 把当前状态已经持续的时间也算进去
+        self.set_state(self.state)
+
+    def to_dict(self) -> dict:
+        return {
+            "index": self.index, "url": self.url, "state": self.state, "bytes": self.bytes,
+            "requests": self.requests, "retries": self.retries, "stalls": self.stalls,
+            "ttfb": round(self.ttfb, 4), "speed": round(self.speed), "ema_speed": round(self.ema_speed),
+            "state_time": {k: round(v, 3) for k, v in self.state_time.items()},
+        }
+
+
+class DownloadMetrics:
+    """一个下载的统计，下载过程中会不断更新，可以在任意时候读取"""
+
+    def __init__(self, url: str, alpha: float = 0.3, stall_timeout: float = 5.0):
+        """
+        :param url: 下载地址
+        :param alpha: 平均速度(EMA)的平滑系数
+        :param stall_timeout: 工作任务超过这么多秒没收到数据就算卡住一次
+        """
+        self.url = url
+        self.alpha = alpha
+        self.stall_timeout = stall_timeout
+        self.size = 0  # 文件大小，0代表未知
+        self.started_at = time.time()
+        self.finished_at = 0.0
+        self.error: Optional[BaseException] = None
+        self.ttfb = 0.0  # 整个下载的首字节时间，秒
+        self.speed = 0.0
+        self.ema_speed = 0.0
+        self.queue_depth = 0  # 已下载但还没交给调用者的块数
+        self.buffered = 0  # 已下载但还没被处理的字节数
+        self.workers: dict[int, WorkerMetrics] = {}
+        self.writer = None  # 保存到文件时的FileWriter，用来读取磁盘写入的统计
+        self._last_time = time.monotonic()
+        self._last_bytes = 0
+
+    @property
+    def bytes(self) -> int:
+        return sum(w.bytes for w in self.workers.values())
+
+    @property
+    def retries(self) -> int:
+        return sum(w.retries for w in self.workers.values())
+
+    @property
+    def stalls(self) -> int:
+        return sum(w.stalls for w in self.workers.values())
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at > 0
+
+    def worker(self, index: int) -> WorkerMetrics:
+        metrics = self.workers.get(index)
+        if metrics is None:
+            metrics = self.workers[index] = WorkerMetrics(index)
+        return metrics
+
+    def first_byte(self):
+        if not self.ttfb:
+            self.ttfb = time.time() - self.started_at
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.update()
+        self.finished_at = time.time()
+        self.error = error
+        for worker in self.workers.values():
+            worker.set_state("idle")
+
+    def update(self) -> "DownloadMetrics":
+        """重新计算速度和卡住的次数，返回自己，由下载器每隔metrics_interval秒调用一次"""
+        if self.finished:
+            return self
+        now = time.monotonic()
+        interval = now - self._last_time
+        if interval <= 0:
+            return self
+        for worker in self.workers.values():
+            worker.update(interval, self.alpha, self.stall_timeout)
+        total = self.bytes
+        self.speed = (total - self._last_bytes) / interval
+        self.ema_speed = self.speed if not self.ema_speed else self.ema_speed * (1 - self.alpha) + self.speed * self.alpha
+        self._last_time, self._last_bytes = now, total
+        return self
+
+    def state_time(self) -> dict[str, float]:
+        """所有工作任务在每个状态上累计的秒数"""
+        result = dict.fromkeys(WorkerMetrics.STATES, 0.0)
+        for worker in self.workers.values():
+            for state, seconds in worker.state_time.items():
+                result[state] += seconds
+        return result
+
+    def disk(self) -> dict:
+        """磁盘写入的统计，没有保存到文件时都是0"""
+        writer = self.writer
+        if writer is None:
+            return {"writes": 0, "bytes": 0, "time": 0.0, "max_time": 0.0}
+        return {"writes": writer.writes, "bytes": writer.written,
+                "time": round(writer.write_time, 4), "max_time": round(writer.max_write_time, 4)}
+
+    def to_dict(self) -> dict:
+        return {
+            "url": self.url, "size": self.size, "bytes": self.bytes, "finished": self.finished,
+            "error": repr(self.error) if self.error else "",
+            "elapsed": round((self.finished_at or time.time()) - self.started_at, 3),
+            "ttfb": round(self.ttfb, 4), "speed": round(self.speed), "ema_speed": round(self.ema_speed),
+            "retries": self.retries, "stalls": self.stalls,
+            "queue_depth": self.queue_depth, "buffered": self.buffered,
+            "state_time": {k: round(v, 3) for k, v in self.state_time().items()},
+            "disk": self.disk(),
+            "workers": [w.to_dict() for w in self.workers.values()],
+        }
+
+
+Observer = Callable[[str, DownloadMetrics], None]  # (事件, 统计)，事件是start、update、finish
+
+
+def render_json(metrics: Iterable[DownloadMetrics]) -> str:
+    return json.dumps([m.to_dict() for m in metrics], ensure_ascii=False)
+
+
+def render_prometheus(metrics: Iterable[DownloadMetrics], prefix: str = "downloader") -> str:
+    """导出为Prometheus的文本格式，和render_json一样只读取，不调用update，不然每次抓取都会改变速度的统计区间"""
+    def label(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    series: dict[str, tuple[str, str, list[str]]] = {}  # 名字->(类型, 说明, 数据行)
+
+    def add(name: str, kind: str, help_text: str, labels: dict, value):
+        lines = series.setdefault(name, (kind, help_text, []))[2]
+        text = ",".join(f'{k}="{label(v)}"' for k, v in labels.items())
+        lines.append(f"{prefix}_{name}{{{text}}} {value}")
+
+    for m in metrics:
+        labels = {"url": m.url}
+        add("size_bytes", "gauge", "文件大小，0代表未知", labels, m.size)
+        add("received_bytes_total", "counter", "收到的字节数", labels, m.bytes)
+        add("speed_bytes", "gauge", "最近一个统计间隔的速度", labels, round(m.speed))
+        add("ema_speed_bytes", "gauge", "平均速度(EMA)", labels, round(m.ema_speed))
+        add("ttfb_seconds", "gauge", "首字节时间", labels, m.ttfb)
+        add("retries_total", "counter", "重试次数", labels, m.retries)
+        add("stalls_total", "counter", "工作任务卡住的次数", labels, m.stalls)
+        add("queue_depth", "gauge", "已下载但还没交给调用者的块数", labels, m.queue_depth)
+        add("buffered_bytes", "gauge", "已下载但还没被处理的字节数", labels, m.buffered)
+        add("finished", "gauge", "是否已经结束", labels, int(m.finished))
+        for state, seconds in m.state_time().items():
+            add("worker_state_seconds_total", "counter", "工作任务在各个状态上累计的时间", {**labels, "state": state}, seconds)
+        disk = m.disk()
+        add("disk_writes_total", "counter", "磁盘写入次数", labels, disk["writes"])
+        add("disk_write_seconds_total", "counter", "磁盘写入累计时间", labels, disk["time"])
+        add("disk_write_max_seconds", "gauge", "单次磁盘写入的最长时间", labels, disk["max_time"])
+        for w in m.workers.values():
+            worker_labels = {**labels, "worker": w.index}
+            add("worker_received_bytes_total", "counter", "每个工作任务收到的字节数", worker_labels, w.bytes)
+            add("worker_speed_bytes", "gauge", "每个工作任务的速度", worker_labels, round(w.speed))
+            add("worker_ttfb_seconds", "gauge", "每个工作任务最近一次请求的首字节时间", worker_labels, w.ttfb)
+    out = []
+    for name, (kind, help_text, lines) in series.items():
+        out.append(f"# HELP {prefix}_{name} {help_text}")
+        out.append(f"# TYPE {prefix}_{name} {kind}")
+        out.extend(lines)
+    return "\n".join(out) + "\n"
+
+
+async def serve_metrics(source: Callable[[], Iterable[DownloadMetrics]], host: str = "127.0.0.1",
+                        port: int = 9100) -> asyncio.AbstractServer:
+    """
+    开启一个简单的http服务，/metrics返回Prometheus格式，/metrics.json返回json
+    :param source: 返回当前所有下载统计的函数，比如lambda: downloader.downloads
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():  # 忽略请求头
+                pass
+            parts = request_line.decode("latin-1").split()
+            path = parts[1] if len(parts) > 1 else "/"
+            if path.startswith("/metrics.json"):
+                status, content_type, body = "200 OK", "application/json", render_json(source())
+            elif path.startswith("/metrics"):
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4", render_prometheus(source())
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+            data = body.encode("utf-8")
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}; charset=utf-8\r\n"
+                         f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1") + data)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
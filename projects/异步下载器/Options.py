@@ -1,9 +1,11 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional
 from pathlib import Path
 from io import FileIO
 from urllib.parse import urlparse
 
+from Progress import DownloadProgress
+
 
 @dataclass(eq=False)  # unsafe_hash在修改对象后移出dict时会报错
 class Options:
@@ -13,10 +15,10 @@ class Options:
     proxy = ""
 
     started = False
-    file_size = -1
-    download_size = 0
     finished = False
     failed = False
+    # 进度由事件循环线程写入，界面只读它的快照
+    progress: DownloadProgress = field(default_factory=DownloadProgress)
 
     def check(self):
         assert self.url, 0
@@ -0,0 +1,93 @@
+"""
+下载进度，和界面分开
+事件循环线程每收到一块数据就调用DownloadProgress.update，但最多每interval秒才生成一次新的ProgressSnapshot；
+快照创建后不再修改，发布时整个替换(引用赋值是原子的)，Qt线程随时读取snapshot都是一致的，不需要加锁
+"""
+import time
+
+
+class ProgressSnapshot:
+    """某一时刻的进度，不要修改"""
+    __slots__ = ("downloaded", "total", "speed", "eta")
+
+    def __init__(self, downloaded: int = 0, total: int = -1, speed: float = 0.0, eta: float = -1):
+        """
+        :param downloaded: 已下载的字节数
+        :param total: 文件大小，-1代表还没开始，0代表未知
+        :param speed: 平均速度，字节/秒
+        :param eta: 预计还要多少秒，-1代表未知
+        """
+        self.downloaded = downloaded
+        self.total = total
+        self.speed = speed
+        self.eta = eta
+
+    def __eq__(self, other):
+        if not isinstance(other, ProgressSnapshot):
+            return NotImplemented
+        return (self.downloaded, self.total, self.speed, self.eta) == (other.downloaded, other.total, other.speed, other.eta)
+
+    def __hash__(self):
+        return hash((self.downloaded, self.total, self.speed, self.eta))
+
+    def __repr__(self):
+        return f"ProgressSnapshot({self.downloaded}/{self.total}, {self.speed:.0f}B/s, eta={self.eta:.1f})"
+
+
+class DownloadProgress:
+    """一个下载项的进度，update和publish只在事件循环线程中调用，其他线程只读snapshot"""
+    __slots__ = ("interval", "alpha", "snapshot", "_downloaded", "_total", "_speed", "_last_time", "_last_size")
+
+    def __init__(self, interval: float = 0.25, alpha: float = 0.3):
+        """
+        :param interval: 最多每隔多少秒发布一次快照
+        :param alpha: 平均速度(EMA)的平滑系数
+        """
+        self.interval = interval
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        """重新开始下载时调用"""
+        self.snapshot = ProgressSnapshot()
+        self._downloaded = 0
+        self._total = -1
+        self._speed = 0.0
+        self._last_time = 0.0
+        self._last_size = 0
+
+    def update(self, downloaded: int, total: int):
+        """下载的进度回调，调用很频繁，大部分时候只记下数字"""
+        self._downloaded = downloaded
+        self._total = total
+        now = time.monotonic()
+        if now - self._last_time >= self.interval:
+            self.publish(now)
+
+    def publish(self, now: float = 0.0):
+        """立即发布快照，下载结束时调用，保证最后的进度能显示出来"""
+        now = now or time.monotonic()
+        elapsed = now - self._last_time
+        if self._last_time and elapsed > 0:  # 第一次只记下起点，续传时已有的部分不算进速度
+            speed = (self._downloaded - self._last_size) / elapsed
+            self._speed = speed if not self._speed else self._speed * (1 - self.alpha) + speed * self.alpha
+        self._last_time, self._last_size = now, self._downloaded
+        eta = (self._total - self._downloaded) / self._speed if self._total > 0 and self._speed > 0 else -1
+        self.snapshot = ProgressSnapshot(self._downloaded, self._total, self._speed, eta)
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f}{unit}" if unit != "B" else f"{size:.0f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
+
+
+def format_eta(seconds: float) -> str:
+    if seconds < 0:
+        return "未知"
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
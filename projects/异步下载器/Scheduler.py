@@ -0,0 +1,441 @@
+import asyncio
+import contextlib
+import time
+from collections import deque
+from typing import Optional, Callable, Union
+
+
+class Segment:
+    """工作任务正在下载的范围，左闭右开，end可能会在下载过程中被其他任务缩短(被偷走后半段)"""
+    __slots__ = ("start", "position", "end", "started_at")
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.position = start  # 已经收到的数据的位置
+        self.end = end
+        self.started_at = time.monotonic()
+
+    @property
+    def remaining(self) -> int:
+        return max(self.end - self.position, 0)
+
+    @property
+    def speed(self) -> float:
+        """平均速度，字节/秒"""
+        elapsed = time.monotonic() - self.started_at
+        if elapsed <= 0:
+            return 0
+        return (self.position - self.start) / elapsed
+
+    def __repr__(self):
+        return f"Segment({self.start}, {self.position}, {self.end})"
+
+
+ChunkSize = Union[int, Callable[[int, int], int], None]
+
+
+class RangeScheduler:
+    """
+    动态分配下载范围
+    空闲的工作任务先从共享池中领取一小块，池子空了就把剩余时间最长的工作任务的后半段偷过来
+    """
+
+    def __init__(self, ranges: list[tuple[int, int]], worker_count: int,
+                 chunk_size: ChunkSize = None, min_split_size: int = 1024 * 1024):
+        """
+        :param ranges: 要下载的范围，闭区间
+        :param worker_count: 工作任务数，用于计算每块的大小
+        :param chunk_size: 每次领取的大小，
+            int代表固定大小，
+            函数代表自定义策略，参数是(池中剩余大小, 工作任务数)，返回领取大小，
+            None代表池中剩余大小/(工作任务数*2)，开始时块大，快结束时块小
+        :param min_split_size: 最小领取大小，剩余小于它两倍的范围不会被偷
+        """
+        self._pool = deque((start, end + 1) for start, end in ranges if end >= start)
+        self.pool_size = sum(end - start for start, end in self._pool)
+        self.worker_count = worker_count
+        self.chunk_size = chunk_size
+        self.min_split_size = min_split_size
+        self.active: set[Segment] = set()
+        self.steal_count = 0
+
+    @property
+    def finished(self) -> bool:
+        return not self._pool and not self.active
+
+    def acquire(self) -> Optional[Segment]:
+        """领取一个范围，没有可以下载的范围时返回None"""
+        if self._pool:
+            segment = self._take_from_pool()
+        else:
+            segment = self._steal()
+        if segment is not None:
+            self.active.add(segment)
+        return segment
+
+    def release(self, segment: Segment):
+        """归还范围，没下载完的部分会放回池子里"""
+        self.active.discard(segment)
+        if segment.position < segment.end:
+            self._pool.appendleft((segment.position, segment.end))
+            self.pool_size += segment.end - segment.position
+
+    def _next_chunk_size(self) -> int:
+        if self.chunk_size is None:
+            size = self.pool_size // (self.worker_count * 2)
+        elif callable(self.chunk_size):
+            size = self.chunk_size(self.pool_size, self.worker_count)
+        else:
+            size = self.chunk_size
+        return max(size, self.min_split_size)
+
+    def _take_from_pool(self) -> Segment:
+        start, end = self._pool.popleft()
+        size = self._next_chunk_size()
+        if end - start > size + self.min_split_size:  # 剩下的太小就一起拿走
+            self._pool.appendleft((start + size, end))
+            end = start + size
+        self.pool_size -= end - start
+        return Segment(start, end)
+
+    def _steal(self) -> Optional[Segment]:
+        def remaining_time(s: Segment):
+            return s.remaining / (s.speed or 1)
+
+        candidates = [s for s in self.active if s.remaining >= self.min_split_size * 2]
+        if not candidates:
+            return None
+        victim = max(candidates, key=remaining_time)
+        middle = victim.position + victim.remaining // 2
+        segment = Segment(middle, victim.end)
+        victim.end = middle
+        self.steal_count += 1
+        return segment
+
+
+class ConcurrencyController:
+    """
+    按照AIMD的方式调整并发连接数
+    每隔一段时间统计一次总速度，加连接能变快就继续加，加了没变快就退回去，变慢了(比如被服务器限流)就按比例减少
+    """
+
+    def __init__(self, initial: int = 4, minimum: int = 1, maximum: int = 30, interval: float = 1.0,
+                 step: int = 2, backoff: float = 0.5, threshold: float = 0.1, hold: int = 3):
+        """
+        :param initial: 初始连接数
+        :param minimum: 最少连接数
+        :param maximum: 最多连接数
+        :param interval: 统计间隔，秒
+        :param step: 每次增加的连接数
+        :param backoff: 变慢时连接数乘以这个系数
+        :param threshold: 速度变化超过这个比例才算变快或变慢
+        :param hold: 退回后保持多少个统计间隔，然后再尝试增加
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.concurrency = max(minimum, min(initial, maximum))
+        self.interval = interval
+        self.step = step
+        self.backoff = backoff
+        self.threshold = threshold
+        self.hold = hold
+        self.speed = 0.0  # 最近一次统计的总速度，字节/秒
+        self.best_speed = 0.0
+        self.best_concurrency = self.concurrency
+        self.history: list[tuple[int, float]] = []  # (连接数, 总速度)
+        self._bytes = 0
+        self._last_time = time.monotonic()
+        self._last_speed: Optional[float] = None
+        self._increased = False
+        self._holding = 0
+
+    @property
+    def speed_per_connection(self) -> float:
+        return self.speed / self.concurrency
+
+    def feed(self, size: int):
+        """记录收到的数据大小"""
+        self._bytes += size
+
+    def update(self) -> int:
+        """统计一次速度并调整连接数，返回新的连接数"""
+        now = time.monotonic()
+        elapsed = now - self._last_time
+        if elapsed <= 0:
+            return self.concurrency
+        speed = self._bytes / elapsed
+        self._bytes = 0
+        self._last_time = now
+        self.speed = speed
+        self.history.append((self.concurrency, speed))
+        if speed > self.best_speed:
+            self.best_speed = speed
+            self.best_concurrency = self.concurrency
+
+        previous, self._last_speed = self._last_speed, speed
+        if previous is None:
+            self._increase()
+        elif speed < previous * (1 - self.threshold) and not self._increased:  # 没加连接却变慢了
+            self._decrease(max(self.minimum, int(self.concurrency * self.backoff)))
+        elif self._increased and speed < previous * (1 + self.threshold):  # 加了连接没变快
+            self._decrease(max(self.minimum, self.concurrency - self.step))
+        elif self._holding > 0:
+            self._holding -= 1
+            self._increased = False
+        else:
+            self._increase()
+        return self.concurrency
+
+    def _increase(self):
+        self._increased = self.concurrency < self.maximum
+        self.concurrency = min(self.maximum, self.concurrency + self.step)
+
+    def _decrease(self, concurrency: int):
+        self.concurrency = concurrency
+        self._increased = False
+        self._holding = self.hold
+
+
+class MemoryBudget:
+    """
+    限制已经下载但还没被调用者处理的数据总大小(字节)
+    额度用完时工作任务会停止读取响应，TCP的流量控制会让服务器暂停发送
+    """
+
+    def __init__(self, limit: int):
+        """
+        :param limit: 最多缓存多少字节，单块数据比它大时，只要没有其他缓存数据也允许通过
+        """
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._waiters: deque[tuple[asyncio.Future, int]] = deque()
+
+    async def acquire(self, size: int):
+        if not self._waiters and self._can_acquire(size):
+            self._take(size)
+            return
+        future = asyncio.get_running_loop().create_future()
+        waiter = (future, size)
+        self._waiters.append(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():  # 已经拿到额度了，还回去
+                self.release(size)
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self, size: int):
+        self.used -= size
+        # 先来先得，避免大块数据一直等不到额度
+        while self._waiters and self._can_acquire(self._waiters[0][1]):
+            future, size = self._waiters.popleft()
+            if not future.done():
+                self._take(size)
+                future.set_result(None)
+
+    def _can_acquire(self, size: int) -> bool:
+        return self.used == 0 or self.used + size <= self.limit
+
+    def _take(self, size: int):
+        self.used += size
+        self.peak = max(self.peak, self.used)
+
+
+class ConnectionLimiter:
+    """
+    限制全局和每个主机的并发连接数，可以被多个下载共用
+    多个下载同时等待时，优先级高的先拿到，优先级相同时分给占用连接最少的下载，让带宽平均分配
+    """
+
+    def __init__(self, max_connections: int = 32, max_connections_per_host: int = 8):
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.active = 0
+        self.hosts: dict[str, int] = {}  # 主机->连接数
+        self.owners: dict[object, int] = {}  # 下载->连接数
+        self.priorities: dict[object, int] = {}  # 下载->优先级，越大越优先
+        self._waiters: list[tuple[asyncio.Future, str, object]] = []
+
+    @contextlib.asynccontextmanager
+    async def connection(self, host: str, owner: object = None):
+        """在with语句中占用一个连接"""
+        await self.acquire(host, owner)
+        try:
+            yield
+        finally:
+            self.release(host, owner)
+
+    async def acquire(self, host: str, owner: object = None):
+        if not self._waiters and self._can_acquire(host):
+            self._take(host, owner)
+            return
+        future = asyncio.get_running_loop().create_future()
+        waiter = (future, host, owner)
+        self._waiters.append(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(host, owner)
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self, host: str, owner: object = None):
+        self.active -= 1
+        self._decrement(self.hosts, host)
+        self._decrement(self.owners, owner)
+        self._wake()
+
+    def _can_acquire(self, host: str) -> bool:
+        return (self.active < self.max_connections
+                and self.hosts.get(host, 0) < self.max_connections_per_host)
+
+    def _take(self, host: str, owner: object):
+        self.active += 1
+        self.hosts[host] = self.hosts.get(host, 0) + 1
+        self.owners[owner] = self.owners.get(owner, 0) + 1
+
+    def _wake(self):
+        while self.active < self.max_connections:
+            candidates = [w for w in self._waiters if not w[0].done() and self._can_acquire(w[1])]
+            if not candidates:
+                break
+            # min按顺序返回第一个最小值，所以同等条件下先来先得
+            waiter = min(candidates, key=lambda w: (-self.priorities.get(w[2], 0), self.owners.get(w[2], 0)))
+            self._waiters.remove(waiter)
+            future, host, owner = waiter
+            self._take(host, owner)
+            future.set_result(None)
+        self._waiters = [w for w in self._waiters if not w[0].done()]
+
+    @staticmethod
+    def _decrement(counter: dict, key):
+        count = counter[key] - 1
+        if count:
+            counter[key] = count
+        else:
+            del counter[key]
+
+
+class TokenBucket:
+    """令牌桶限速，可以被多个下载共用"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        """
+        :param rate: 每秒多少字节，0代表不限速
+        :param burst: 桶的容量，默认是一秒的量
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self._last_time = time.monotonic()
+
+    async def consume(self, size: int):
+        """
+        消耗令牌，不够时等待
+        允许令牌变成负数(欠账)，之后的调用者要多等一会，这样大块数据也能限速，等待顺序也是先来先得
+        """
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._last_time) * self.rate)
+        self._last_time = now
+        self.tokens -= size
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class Mirror:
+    """同一个文件的一个下载源"""
+    __slots__ = ("url", "active", "speed", "errors", "dropped")
+
+    def __init__(self, url: str):
+        self.url = url
+        self.active = 0  # 正在使用的连接数
+        self.speed = 0.0  # 每个连接的平均速度，字节/秒，0代表还没测出来
+        self.errors = 0  # 连续出错的次数
+        self.dropped = False
+
+    def __repr__(self):
+        return f"Mirror({self.url!r}, active={self.active}, speed={self.speed / 1024:.1f}KB/s, dropped={self.dropped})"
+
+
+class MirrorSelector:
+    """
+    在多个镜像之间分配请求，每次发请求前选一个镜像
+    - 选 每个连接的速度/(正在使用的连接数+1) 最大的镜像，速度快的镜像分到的连接多；
+      还没测出速度的镜像按最快的算，保证每个镜像都会被尝试
+    - 连续出错max_errors次、出现不能重试的错误、或者速度不到最快镜像的min_ratio的镜像会被放弃，但至少保留一个
+    """
+
+    def __init__(self, urls: list[str], max_errors: int = 3, min_ratio: float = 0.1, smoothing: float = 0.3):
+        """
+        :param urls: 镜像地址，第一个是主地址
+        :param max_errors: 连续出错多少次后放弃
+        :param min_ratio: 速度低于最快镜像的这个比例时放弃
+        :param smoothing: 速度的平滑系数，越大越看重最近一次请求的速度
+        """
+        self.mirrors = [Mirror(url) for url in urls]
+        self.max_errors = max_errors
+        self.min_ratio = min_ratio
+        self.smoothing = smoothing
+
+    @property
+    def primary(self) -> Mirror:
+        return self.mirrors[0]
+
+    @property
+    def alive(self) -> list[Mirror]:
+        return [m for m in self.mirrors if not m.dropped]
+
+    def choose(self) -> Mirror:
+        """选一个镜像并占用一个连接，用完后需要调用release"""
+        alive = self.alive
+        best = max(m.speed for m in alive) or 1.0
+        mirror = max(alive, key=lambda m: (m.speed or best) / (m.active + 1))
+        mirror.active += 1
+        return mirror
+
+    def use(self, mirror: Mirror) -> Mirror:
+        """指定使用某个镜像，用完后同样需要调用release"""
+        mirror.active += 1
+        return mirror
+
+    def release(self, mirror: Mirror, size: int, elapsed: float, ok=True):
+        """
+        请求结束，记录这次请求的速度
+        :param size: 这次请求收到的数据大小
+        :param elapsed: 这次请求用的时间，秒
+        :param ok: 请求是否正常结束，出错时先调用fail
+        """
+        mirror.active -= 1
+        if ok:
+            mirror.errors = 0
+        if size <= 0 or elapsed <= 0:
+            return
+        speed = size / elapsed
+        mirror.speed = speed if not mirror.speed else mirror.speed * (1 - self.smoothing) + speed * self.smoothing
+        best = max(m.speed for m in self.alive)
+        for m in self.alive:
+            if m.speed and m.speed < best * self.min_ratio:
+                self._drop(m)
+
+    def fail(self, mirror: Mirror, fatal=False) -> bool:
+        """
+        记录一次错误，返回镜像是否被放弃
+        :param fatal: 是否是不能重试的错误(比如404)，是的话直接放弃
+        """
+        mirror.errors += 1
+        if fatal or mirror.errors >= self.max_errors:
+            return self._drop(mirror)
+        return False
+
+    def _drop(self, mirror: Mirror) -> bool:
+        if mirror.dropped or len(self.alive) <= 1:
+            return False
+        mirror.dropped = True
+        return True
@@ -1,5 +1,6 @@
 import subprocess
 from pathlib import Path
+from typing import Optional
 from urllib.parse import urlparse
 
 from PyQt5.QtGui import QIcon, QColor
@@ -10,6 +11,7 @@ from qfluentwidgets import (
     Flyout, IndeterminateProgressBar, TeachingTip, InfoBarIcon, TeachingTipTailPosition)
 
 from Options import Options
+from Progress import format_size, format_eta
 
 
 # noinspection PyTypeChecker
@@ -36,6 +38,8 @@ class Window(QWidget):
         self.progress_bar_stack = QStackedWidget()
         self.progress_bar = ProgressBar(useAni=True)
         self.indeterminate_progress_bar = IndeterminateProgressBar(start=False)
+        self.progress_label = CaptionLabel()  # 速度和剩余时间
+        self._shown_progress: Optional[tuple] = None  # 上次显示的(选项, 内容)，没变就不用重绘
         # 绑定信号，设置ui
         self.bind_signals()
         self.setup_ui()
@@ -154,28 +158,53 @@ class Window(QWidget):
         return options
 
     def update_progress_bar(self):
+        """只显示当前标签页的进度，要显示的内容和上次一样时什么都不做"""
         options = self.tab_bar.currentTab().routeKey()
+        snapshot = options.progress.snapshot
+        text = ""
         if options.failed:  # 失败
+            view = ("failed", snapshot.total, snapshot.downloaded)
+        elif options.finished:  # 完成就是满进度条
+            view = ("finished", snapshot.total)
+        elif snapshot.total == -1:  # 没开始下
+            view = ("waiting",)
+        else:  # 进行中或者暂停了
+            if snapshot.total == 0:  # 0代表未知文件大小
+                text = format_size(snapshot.downloaded)
+                if options.started:
+                    text += f"  {format_size(snapshot.speed)}/s"
+                view = ("unknown", text)
+            else:
+                text = f"{format_size(snapshot.downloaded)}/{format_size(snapshot.total)}"
+                if options.started:
+                    text += f"  {format_size(snapshot.speed)}/s  剩余{format_eta(snapshot.eta)}"
+                view = ("running", snapshot.total, snapshot.downloaded, text)
+        if (options, view) == self._shown_progress:
+            return
+        self._shown_progress = (options, view)
+        self.progress_label.setText(text)
+
+        if options.failed:
             self.progress_bar.setCustomBarColor("red", "red")
-            if options.file_size == 0:  # 如果是未知文件大小，就设置一般进度条
+            if snapshot.total == 0:  # 如果是未知文件大小，就设置一般进度条
                 self.progress_bar_stack.setCurrentWidget(self.progress_bar)
-                self.progress_bar.setVal(options.file_size // 2)
-        elif options.finished:  # 完成就是满进度条
+                self.progress_bar.setVal(snapshot.total // 2)
+        elif options.finished:
             self.progress_bar_stack.setCurrentWidget(self.progress_bar)
-            self.progress_bar.setVal(options.file_size)
-        else:  # 进行中
+            self.progress_bar.setVal(snapshot.total)
+        else:
             self.progress_bar.setCustomBarColor(QColor(), QColor())
             self.indeterminate_progress_bar.setCustomBarColor(QColor(), QColor())
 
-            if options.file_size != -1:  # -1代表没开始下
-                if options.file_size == 0:  # 0代表未知文件大小
+            if snapshot.total != -1:
+                if snapshot.total == 0:
                     self.progress_bar_stack.setCurrentWidget(self.indeterminate_progress_bar)
                     self.indeterminate_progress_bar.start()
                 else:  # 有文件大小
                     self.indeterminate_progress_bar.stop()
                     self.progress_bar_stack.setCurrentWidget(self.progress_bar)
-                    self.progress_bar.setMaximum(options.file_size)
-                    self.progress_bar.setValue(options.download_size)
+                    self.progress_bar.setMaximum(snapshot.total)
+                    self.progress_bar.setValue(snapshot.downloaded)
             else:
                 self.indeterminate_progress_bar.stop()  # 没开始下
                 self.progress_bar_stack.setCurrentWidget(self.indeterminate_progress_bar)
@@ -233,6 +262,7 @@ class Window(QWidget):
         self.progress_bar_stack.addWidget(self.progress_bar)
         self.progress_bar_stack.addWidget(self.indeterminate_progress_bar)
         form_layout.addRow(self.progress_bar_stack)
+        form_layout.addRow(self.progress_label)
 
         layout = QVBoxLayout(self)
         layout.addWidget(self.tab_bar)
@@ -0,0 +1,189 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+
+def _open(path: str, truncate: bool) -> int:
+    flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+    if truncate:
+        flags |= os.O_TRUNC
+    return os.open(path, flags, 0o666)
+
+
+def _preallocate(fd: int, size: int):
+    """预分配文件大小，支持fallocate的系统上会真的分配磁盘空间，避免写到一半磁盘满了，也能减少碎片"""
+    if size <= 0 or os.fstat(fd).st_size >= size:
+        return
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:  # 有些文件系统不支持
+            pass
+    os.ftruncate(fd, size)
+
+
+class FileWriter:
+    """
+    按位置写入的文件写入器，用于多个范围同时写入同一个文件
+    - 创建时预分配文件大小
+    - 使用os.pwrite/os.pwritev写入，不依赖文件指针，多个线程可以同时写
+    - 先把数据攒在内存里，攒够batch_size再一次写入，异步写入时每批只切换一次线程
+    """
+    def __init__(self, path: str, size: int = 0, truncate=True,
+                 batch_size: int = 1024 * 1024, max_pending: int = 16 * 1024 * 1024):
+        """
+        :param path: 文件路径
+        :param size: 文件大小，大于0时会预分配
+        :param truncate: 是否清空原文件，断点续传时需要设为False
+        :param batch_size: 攒够多少数据写一次
+        :param max_pending: 异步写入时，最多有多少数据在后台线程中等待写入，超过后write_async会等待
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.fd = _open(path, truncate)
+        _preallocate(self.fd, size)
+        self._runs: dict[int, tuple[int, list[bytes]]] = {}  # 结束位置->(开始位置, 数据块)，每个范围的数据通常是连续的
+        self._buffered = 0
+        self._flushing: deque[tuple[asyncio.Future, int]] = deque()
+        self._pending = 0
+        # 不支持pwrite时只能seek+write，需要加锁
+        self._lock = None if hasattr(os, "pwrite") else threading.Lock()
+        # 磁盘写入的统计，每批算一次，多个线程池线程会同时更新，需要加锁
+        self._stats_lock = threading.Lock()
+        self.writes = 0
+        self.written = 0
+        self.write_time = 0.0
+        self.max_write_time = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close_async()
+
+    @property
+    def buffered_size(self) -> int:
+        """还没写入文件的数据大小"""
+        return self._buffered + self._pending
+
+    def write(self, chunk: bytes, offset: int):
+        if self._add(chunk, offset):
+            self._write_batch(self._take_batch())
+
+    async def write_async(self, chunk: bytes, offset: int):
+        if not self._add(chunk, offset):
+            return
+        while self._flushing and self._pending >= self.max_pending:  # 磁盘比网络慢时在这里等待
+            await self._wait_oldest()
+        batch = self._take_batch()
+        size = sum(len(c) for _, chunks in batch for c in chunks)
+        future = asyncio.get_running_loop().run_in_executor(None, self._write_batch, batch)
+        self._flushing.append((future, size))
+        self._pending += size
+
+    def flush(self):
+        """把内存中的数据写入文件"""
+        self._write_batch(self._take_batch())
+
+    async def flush_async(self):
+        """把内存中的数据写入文件，并等待后台写入完成"""
+        batch = self._take_batch()
+        if batch:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_batch, batch)
+        while self._flushing:
+            await self._wait_oldest()
+
+    def read(self, offset: int, size: int) -> bytes:
+        """读取已写入文件的数据，缓冲区中的数据需要先flush"""
+        if self._lock is None:
+            return os.pread(self.fd, size, offset)
+        with self._lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, size)
+
+    def close(self):
+        if self.fd < 0:
+            return
+        try:
+            self.flush()
+        finally:
+            os.close(self.fd)
+            self.fd = -1
+
+    async def close_async(self):
+        if self.fd < 0:
+            return
+        try:
+            await self.flush_async()
+        finally:
+            os.close(self.fd)
+            self.fd = -1
+
+    def _add(self, chunk: bytes, offset: int) -> bool:
+        """把数据放进缓冲区，返回是否需要写入"""
+        start, chunks = self._runs.pop(offset, (offset, []))
+        chunks.append(chunk)
+        self._runs[offset + len(chunk)] = (start, chunks)
+        self._buffered += len(chunk)
+        return self._buffered >= self.batch_size
+
+    def _take_batch(self) -> list[tuple[int, list[bytes]]]:
+        batch = list(self._runs.values())
+        self._runs = {}
+        self._buffered = 0
+        return batch
+
+    async def _wait_oldest(self):
+        future, size = self._flushing.popleft()
+        try:
+            await future
+        finally:
+            self._pending -= size
+
+    def _write_batch(self, batch: list[tuple[int, list[bytes]]]):
+        if not batch:
+            return
+        start = time.perf_counter()
+        self._write_runs(batch)
+        elapsed = time.perf_counter() - start
+        size = sum(len(c) for _, chunks in batch for c in chunks)
+        with self._stats_lock:
+            self.writes += 1
+            self.written += size
+            self.write_time += elapsed
+            self.max_write_time = max(self.max_write_time, elapsed)
+
+    def _write_runs(self, batch: list[tuple[int, list[bytes]]]):
+        for offset, chunks in batch:
+            if self._lock is not None:
+                with self._lock:
+                    os.lseek(self.fd, offset, os.SEEK_SET)
+                    data = b"".join(chunks)
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(self.fd, view):]
+                continue
+            if hasattr(os, "pwritev") and len(chunks) <= 1024:  # IOV_MAX一般是1024
+                size = sum(len(c) for c in chunks)
+                written = os.pwritev(self.fd, chunks, offset)
+                if written == size:
+                    continue
+                data = memoryview(b"".join(chunks))[written:]
+                offset += written
+            else:
+                data = memoryview(b"".join(chunks))
+            while data:
+                written = os.pwrite(self.fd, data, offset)
+                data = data[written:]
+                offset += written
+
@@ -0,0 +1,125 @@
+"""
+命令行批量下载，不需要图形界面
+python cli.py manifest.jsonl --output-dir downloads
+
+清单文件支持两种格式
+- jsonl: 每行一个json，{"url": "...", "path": "...", "checksum": "sha256:..."}，path和checksum可以省略
+- csv/tsv: 每行 url,path,checksum，path和checksum可以省略
+checksum的格式是"算法:十六进制摘要"，省略算法时是sha256，下载时边下载边校验
+进度以json行的形式输出到标准输出，有下载失败时退出码为1
+"""
+import asyncio
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+import typer
+
+from Integrity import IntegrityError
+from Manager import DownloadManager, DownloadJob
+from Metrics import serve_metrics
+
+
+@dataclass
+class Entry:
+    url: str
+    path: str
+    checksum: str = ""
+
+
+def read_manifest(manifest: str, output_dir: str) -> list[Entry]:
+    entries = []
+    with open(manifest, "r", encoding="utf-8", newline="") as f:
+        if manifest.endswith(".jsonl") or manifest.endswith(".json"):
+            rows = ((d.get("url", ""), d.get("path", ""), d.get("checksum", ""))
+                    for d in (json.loads(line) for line in f if line.strip()))
+        else:
+            rows = csv.reader(f, delimiter="\t" if manifest.endswith(".tsv") else ",")
+        for row in rows:
+            if not row or not row[0] or row[0].startswith("#"):
+                continue
+            url, path, checksum = (list(row) + ["", ""])[:3]
+            url, path, checksum = url.strip(), path.strip(), checksum.strip()
+            if not path or path.endswith(("/", "\\")):  # 没写文件名就用链接里的
+                path = os.path.join(path, urlparse(url).path.split("/")[-1] or "index.html")
+            entries.append(Entry(url, os.path.join(output_dir, path), checksum))
+    return entries
+
+
+def emit(event: str, **fields):
+    print(json.dumps({"event": event, "time": round(time.time(), 3), **fields}, ensure_ascii=False), flush=True)
+
+
+async def run(entries: list[Entry], interval: float, metrics_port: int = 0, **manager_options) -> list[dict]:
+    failures = []
+
+    def on_done(job: DownloadJob):
+        if job.state == DownloadJob.FINISHED:
+            emit("finished", url=job.url, path=job.path, size=job.download_size)
+            return
+        state = "corrupted" if isinstance(job.error, IntegrityError) else job.state  # 下载完成但校验失败
+        failure = {"url": job.url, "path": job.path, "state": state, "error": repr(job.error) if job.error else ""}
+        failures.append(failure)
+        emit("failed", **failure)
+
+    async with DownloadManager(**manager_options) as manager:
+        server = await serve_metrics(lambda: manager.metrics, port=metrics_port) if metrics_port else None
+        for entry in entries:
+            os.makedirs(os.path.dirname(entry.path) or ".", exist_ok=True)
+            manager.add(entry.url, entry.path, on_done=on_done, checksum=entry.checksum)
+        emit("queued", count=len(entries))
+
+        join = asyncio.ensure_future(manager.join())
+        last = {}
+        while not join.done():
+            await asyncio.wait([join], timeout=interval)
+            now = time.monotonic()
+            for job in manager.jobs:
+                if job.state != DownloadJob.RUNNING:
+                    continue
+                size, at = last.get(job, (job.download_size, now - interval))
+                speed = (job.download_size - size) / max(now - at, 1e-6)
+                last[job] = (job.download_size, now)
+                emit("progress", url=job.url, path=job.path, downloaded=job.download_size,
+                     total=job.file_size, speed=round(speed))
+        if server is not None:
+            server.close()
+    return failures
+
+
+def main(
+    manifest: str = typer.Argument(..., help="清单文件，jsonl/csv/tsv"),
+    output_dir: str = typer.Option(".", help="保存目录，清单中的相对路径基于此目录"),
+    max_downloads: int = typer.Option(4, min=1, help="同时下载的文件数"),
+    max_connections: int = typer.Option(32, min=1, help="总连接数"),
+    max_connections_per_host: int = typer.Option(8, min=1, help="每个主机的连接数"),
+    max_workers: int = typer.Option(8, min=1, help="每个文件的最大连接数"),
+    rate_limit: float = typer.Option(0, min=0, help="总速度上限，字节/秒，0代表不限速"),
+    http2: bool = typer.Option(False, help="启用HTTP/2，需要安装h2"),
+    interval: float = typer.Option(1.0, min=0.1, help="输出进度的间隔，秒"),
+    metrics_port: int = typer.Option(0, min=0, help="在这个端口提供/metrics(Prometheus格式)和/metrics.json，0代表不开启"),
+):
+    """批量下载清单中的文件"""
+    entries = read_manifest(manifest, output_dir)
+    failures = asyncio.run(run(
+        entries, interval, metrics_port,
+        max_downloads=max_downloads, max_connections=max_connections,
+        max_connections_per_host=max_connections_per_host, rate_limit=rate_limit, max_workers=max_workers,
+        http2=http2))
+    emit("summary", total=len(entries), succeeded=len(entries) - len(failures), failed=len(failures), failures=failures)
+    if failures:
+        print(f"{len(failures)}/{len(entries)}个文件下载失败", file=sys.stderr)
+        for failure in failures:
+            print(f"  {failure['url']} -> {failure['path']}: {failure['error'] or failure['state']}", file=sys.stderr)
+        raise typer.Exit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    typer.run(main)
@@ -0,0 +1,135 @@
+"""
+下载器的回归测试，用pytest运行，也可以直接运行
+python -m pytest test_downloader.py
+"""
+import asyncio
+import os
+import tempfile
+
+import httpx
+
+from Benchmark import mock_client
+from Downloader import Downloader
+from Manager import DownloadManager, DownloadJob
+from Scheduler import ConnectionLimiter
+
+DATA = os.urandom(3 * 1024 * 1024)
+
+
+def test_manager_client_error():
+    """创建http客户端时出错，下载项应该失败并结束，join不能卡住"""
+    async def run():
+        async with DownloadManager(loop=asyncio.get_running_loop()) as manager:
+            def broken_client(proxy: str):
+                raise ImportError("h2 is not installed")
+
+            manager._client = broken_client
+            job = manager.add("http://127.0.0.1:1/file", os.path.join(tempfile.mkdtemp(), "file"))
+            await asyncio.wait_for(manager.join(), 5)
+            assert job.state == DownloadJob.FAILED
+            assert isinstance(job.error, ImportError)
+            assert not manager._running
+
+    asyncio.run(run())
+
+
+def test_manager_proxy_client():
+    """httpx 0.28去掉了proxies参数，创建带代理的客户端不能出错"""
+    async def run():
+        async with DownloadManager(loop=asyncio.get_running_loop()) as manager:
+            assert manager._client("http://127.0.0.1:8080") is manager._client("http://127.0.0.1:8080")
+
+    asyncio.run(run())
+
+
+def test_save_error_releases_probe():
+    """保存前出错(摘要算法不支持、文件打不开)时，留给下载的探测响应要关闭，不能占着连接数"""
+    async def run():
+        limiter = ConnectionLimiter(max_connections_per_host=1)
+        async with Downloader(mock_client(DATA), loop=asyncio.get_running_loop(), limiter=limiter) as downloader:
+            directory = tempfile.mkdtemp()
+            for path, checksum, error in ((os.path.join(directory, "a"), "foo:00", ValueError),
+                                          (os.path.join(directory, "missing", "b"), "", FileNotFoundError)):
+                for resume in (False, True):
+                    try:
+                        await downloader.save_async("http://test/file", path, resume=resume, checksum=checksum)
+                    except error:
+                        pass
+                    else:
+                        raise AssertionError("应该出错")
+                    assert limiter.active == 0
+            path = os.path.join(directory, "c")
+            await asyncio.wait_for(downloader.save_async("http://test/file", path), 5)
+            with open(path, "rb") as f:
+                assert f.read() == DATA
+
+    asyncio.run(run())
+
+
+def changing_client(state: dict) -> httpx.AsyncClient:
+    """返回state["data"]的客户端，state["etag"]为空时不返回ETag，测试中可以随时换掉文件"""
+    async def handler(request: httpx.Request) -> httpx.Response:
+        response = await mock_client(state["data"])._transport.handle_async_request(request)
+        if state["etag"]:
+            response.headers["etag"] = state["etag"]
+        else:
+            del response.headers["etag"]
+        return response
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def check_changed_file(etag: str, new_etag: str):
+    """同一个下载器再次下载同一个url时文件变了，应该下载到新的文件，而不是按旧的探测结果截断或者出错"""
+    async def run():
+        state = {"data": os.urandom(1024 * 1024), "etag": etag}
+        async with Downloader(changing_client(state), loop=asyncio.get_running_loop()) as downloader:
+            assert await downloader.get_async("http://test/file") == state["data"]
+            state.update(data=os.urandom(3 * 1024 * 1024), etag=new_etag)
+            assert await downloader.get_async("http://test/file") == state["data"]
+            path = os.path.join(tempfile.mkdtemp(), "file")
+            await downloader.save_async("http://test/file", path)
+            state.update(data=os.urandom(2 * 1024 * 1024), etag=etag)
+            await downloader.save_async("http://test/file", path)
+            with open(path, "rb") as f:
+                assert f.read() == state["data"]
+
+    asyncio.run(run())
+
+
+def test_changed_file_without_validators():
+    check_changed_file("", "")
+
+
+def test_changed_file_etag():
+    check_changed_file('"v1"', '"v2"')
+
+
+def test_probe_retries():
+    """连不上服务器时探测只重试probe_retries次，不会按max_retries等上好几分钟"""
+    attempts = 0
+
+    async def refuse(request: httpx.Request) -> httpx.Response:
+        nonlocal attempts
+        attempts += 1
+        raise httpx.ConnectError("refused", request=request)
+
+    async def run():
+        async with Downloader(httpx.AsyncClient(transport=httpx.MockTransport(refuse)), loop=asyncio.get_running_loop(),
+                              retry_backoff=0.01, probe_retries=2) as downloader:
+            try:
+                await downloader.get_async("http://test/file")
+            except httpx.ConnectError:
+                pass
+            else:
+                raise AssertionError("应该出错")
+
+    asyncio.run(run())
+    assert attempts == 3
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
@@ -1,60 +1,1243 @@
 import typer
 import logging
 import asyncio
-from functools import partial
+import bisect
+import collections
+import hashlib
+import itertools
+import math
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from dataclasses import dataclass
+from typing import Optional, Callable, Awaitable, TypeVar
 
+DEFAULT_BUFFER_SIZE = 256 * 1024
+# 转发引擎：
+# stream: asyncio的StreamReader/StreamWriter，兼容性最好
+# socket: 直接用socket，每个方向一个复用的缓冲区，recv_into收进来再sendall出去，发不出去时不会再收
+# splice: 只支持Linux，通过管道在内核中把数据从一个socket搬到另一个socket，数据不经过Python
+# protocol: 基于asyncio.BufferedProtocol，没有协程和StreamReader的开销，适合大量并发连接
+ENGINES = ("stream", "socket", "splice", "protocol")
+# 目标池的负载均衡策略：轮询、最少连接、按客户端IP一致性哈希(同一个客户端总是连到同一个目标)
+BALANCES = ("round_robin", "least_conn", "hash")
+T = TypeVar("T")
+WARM_TICK = 0.5  # 预热连接池每隔多少秒调整一次
+STATS_INTERVAL = 1.0  # 多进程模式下工作进程每隔多少秒上报一次统计
 
-async def handle_conn(target_ip: str, target_port: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    conn_addr = writer.get_extra_info('peername')
-    conn_addr = f"{conn_addr[0]}:{conn_addr[1]}"
+
+IN, OUT = 0, 1  # 流量方向：客户端->目标，目标->客户端
+
+
+class Histogram:
+    """Prometheus风格的直方图，只记每个区间的次数和总和，observe只是一次二分查找和两次加法"""
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最后一个区间是+Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Stats:
+    """一个监听地址的统计，只在事件循环线程中修改，热路径上只是加几个数，开销可以忽略"""
+    __slots__ = ("accepted", "active", "connect_errors", "transfer_errors", "traffic", "connect_time", "duration")
+    GAUGES = ("active",)  # 当前值，其他的是累计值
+    CONNECT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    DURATION_BUCKETS = (0.01, 0.1, 1.0, 10.0, 60.0, 300.0, 1800.0, 3600.0)
+
+    def __init__(self):
+        self.accepted = 0  # 接受的连接数
+        self.active = 0  # 正在转发的连接数
+        self.connect_errors = 0  # 所有目标都连不上的次数
+        self.transfer_errors = 0  # 转发出错的次数
+        self.traffic = [0, 0]  # 按IN、OUT方向转发的字节数
+        self.connect_time = Histogram(self.CONNECT_BUCKETS)  # 连接目标用的时间，用预热连接时接近0
+        self.duration = Histogram(self.DURATION_BUCKETS)  # 连接从接受到断开的时间
+
+    def snapshot(self) -> dict:
+        """可以pickle的副本，多进程模式下发给主进程"""
+        result = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if isinstance(value, Histogram):
+                value = (list(value.counts), value.sum)
+            elif isinstance(value, list):
+                value = list(value)
+            result[name] = value
+        return result
+
+    def merge(self, snapshot: dict, gauges: bool = True):
+        """把另一份统计加到这里，gauges为False时不加当前值，用于已经退出的进程"""
+        for name, value in snapshot.items():
+            if name in self.GAUGES and not gauges:
+                continue
+            current = getattr(self, name)
+            if isinstance(current, Histogram):
+                counts, total = value
+                current.counts = [a + b for a, b in zip(current.counts, counts)]
+                current.sum += total
+            elif isinstance(current, list):
+                setattr(self, name, [a + b for a, b in zip(current, value)])
+            else:
+                setattr(self, name, current + value)
+
+    def __str__(self):
+        return (f"活动连接{self.active}，已接受{self.accepted}，"
+                f"出错{self.connect_errors + self.transfer_errors}，"
+                f"上传{self.traffic[IN]}字节，下载{self.traffic[OUT]}字节")
+
+
+listener_stats: dict[str, Stats] = {}  # 每个监听地址的统计，监听重启后接着用
+
+
+def get_stats(bind_ip: str, bind_port: int) -> Stats:
+    key = f"{bind_ip}:{bind_port}"
+    if key not in listener_stats:
+        listener_stats[key] = Stats()
+    return listener_stats[key]
+
+
+def render_metrics(all_stats: dict[str, Stats]) -> str:
+    """Prometheus的文本格式"""
+    lines = []
+
+    def metric(name: str, kind: str, help_text: str):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def histogram(name: str, listen: str, value: Histogram):
+        cumulative = 0
+        for bound, count in zip(value.bounds + (float("inf"),), value.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{name}_bucket{{listen="{listen}",le="{le}"}} {cumulative}')
+        lines.append(f'{name}_sum{{listen="{listen}"}} {value.sum}')
+        lines.append(f'{name}_count{{listen="{listen}"}} {cumulative}')
+
+    items = sorted(all_stats.items())
+    metric("forward_connections_accepted_total", "counter", "Accepted client connections")
+    lines.extend(f'forward_connections_accepted_total{{listen="{listen}"}} {s.accepted}' for listen, s in items)
+    metric("forward_connections_active", "gauge", "Connections currently being forwarded")
+    lines.extend(f'forward_connections_active{{listen="{listen}"}} {s.active}' for listen, s in items)
+    metric("forward_errors_total", "counter", "Upstream connect failures and transfer errors")
+    for listen, s in items:
+        lines.append(f'forward_errors_total{{listen="{listen}",kind="connect"}} {s.connect_errors}')
+        lines.append(f'forward_errors_total{{listen="{listen}",kind="transfer"}} {s.transfer_errors}')
+    metric("forward_bytes_total", "counter", "Forwarded bytes, in is client to upstream")
+    for listen, s in items:
+        lines.append(f'forward_bytes_total{{listen="{listen}",direction="in"}} {s.traffic[IN]}')
+        lines.append(f'forward_bytes_total{{listen="{listen}",direction="out"}} {s.traffic[OUT]}')
+    metric("forward_upstream_connect_seconds", "histogram", "Time to get a connected upstream socket")
+    for listen, s in items:
+        histogram("forward_upstream_connect_seconds", listen, s.connect_time)
+    metric("forward_connection_duration_seconds", "histogram", "Lifetime of forwarded connections")
+    for listen, s in items:
+        histogram("forward_connection_duration_seconds", listen, s.duration)
+    return "\n".join(lines) + "\n"
+
+
+async def serve_stats(host: str, port: int, collect: Callable[[], dict[str, Stats]]) -> asyncio.AbstractServer:
+    """统计接口，GET /metrics返回Prometheus文本格式，只在有人来取时才生成"""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+            if path.split(b"?")[0] in (b"/", b"/metrics"):
+                status, body = "200 OK", render_metrics(collect()).encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logging.info("统计接口 http://%s:%s/metrics", host, port)
+    return server
+
+
+# 正在转发的连接任务，停止监听后也要继续运行；
+# stream引擎的StreamReaderProtocol只弱引用StreamReader，客户端那边读完以后任务可能没有别的引用，会被垃圾回收
+_connections: set[asyncio.Task] = set()
+
+
+class Upstream:
+    """目标池中的一个目标"""
+    __slots__ = ("host", "port", "active", "failures", "healthy", "ejected_until",
+                 "idle", "pending", "demand", "rate", "desired")
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.active = 0  # 正在转发的连接数
+        self.failures = 0  # 连续连接失败的次数
+        self.healthy = True  # 主动健康检查的结果
+        self.ejected_until = 0.0  # 连续失败太多次后，在这个时间之前不再使用
+        # 预热连接池
+        self.idle: collections.deque[tuple[socket.socket, float]] = collections.deque()  # (已连接的socket, 建立的时间)
+        self.pending = 0  # 正在建立的预热连接数
+        self.demand = 0  # 这一轮分到的新连接数
+        self.rate = 0.0  # 平均每秒分到的新连接数
+        self.desired = 1  # 要保持的空闲连接数
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and self.ejected_until <= time.monotonic()
+
+    def __str__(self):
+        return f"{self.host}:{self.port}"
+
+
+class UpstreamPool:
+    """
+    一组目标，按策略选择；连接失败时马上换下一个，客户端感觉不到
+    - 被动剔除：连续失败max_fails次后eject_time秒内不再使用
+    - 主动检查：每隔health_interval秒尝试连接每个目标，连不上的标记为不健康，连上了再恢复
+    - 预热：warm大于0时为每个目标提前建立空闲连接，新客户端直接用，省掉一次连接的往返时间；
+      空闲连接数跟着新连接的速度变化，最多warm个，空闲超过idle_timeout秒的关掉
+    所有目标都不可用时仍然会按顺序尝试，总比直接拒绝好
+    """
+    VIRTUAL_NODES = 64  # 一致性哈希中每个目标的虚拟节点数，越多越均匀
+
+    def __init__(self, targets: tuple[tuple[str, int], ...], balance: str = "round_robin", connect_timeout: float = 5.0,
+                 max_fails: int = 3, eject_time: float = 30.0, health_interval: float = 5.0, health_timeout: float = 2.0,
+                 warm: int = 0, idle_timeout: float = 30.0):
+        self.upstreams = [Upstream(host, port) for host, port in targets]
+        self.balance = balance
+        self.connect_timeout = connect_timeout
+        self.max_fails = max_fails
+        self.eject_time = eject_time
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.warm = warm
+        self.idle_timeout = idle_timeout
+        self._counter = itertools.count()
+        self._ring: list[tuple[int, int]] = sorted(
+            (self._hash(f"{u}#{i}"), index) for index, u in enumerate(self.upstreams) for i in range(self.VIRTUAL_NODES))
+        self._ring_keys = [key for key, _ in self._ring]
+        self._health_task: Optional[asyncio.Task] = None
+        self._warm_task: Optional[asyncio.Task] = None
+        self._warming: set[asyncio.Task] = set()
+
+    def __str__(self):
+        return ",".join(str(u) for u in self.upstreams)
+
+    @staticmethod
+    def _hash(text: str) -> int:
+        return int.from_bytes(hashlib.md5(text.encode()).digest()[:8], "big")
+
+    def candidates(self, client_ip: str = "") -> list[Upstream]:
+        """按策略排好的尝试顺序，可用的在前"""
+        upstreams = self.upstreams
+        if self.balance == "least_conn":
+            order = sorted(upstreams, key=lambda u: u.active)
+        elif self.balance == "round_robin":  # 只在可用的目标之间轮流
+            available = [u for u in upstreams if u.available] or upstreams
+            start = next(self._counter) % len(available)
+            order = available[start:] + available[:start]
+            return order + [u for u in upstreams if u not in order]
+        else:  # 哈希
+            start = bisect.bisect(self._ring_keys, self._hash(client_ip)) % len(self._ring)
+            order, seen = [], set()
+            for _, index in itertools.chain(self._ring[start:], self._ring[:start]):  # 顺着环往后找，目标不可用时就是下一个
+                if index not in seen:
+                    seen.add(index)
+                    order.append(upstreams[index])
+                    if len(order) == len(upstreams):
+                        break
+        return sorted(order, key=lambda u: not u.available)  # sorted是稳定的，可用的目标保持原来的顺序
+
+    async def connect(self, client_ip: str,
+                      adopt: Optional[Callable[[socket.socket], Awaitable[T]]] = None) -> tuple[Upstream, T]:
+        """
+        按顺序尝试连接，有预热的连接就直接用，返回(目标, adopt(已连接的socket)的结果)，没有adopt时返回socket
+        成功后目标的连接数加一，用完要调用release；所有目标都连不上时抛出最后一个错误
+        """
+        error: Optional[Exception] = None
+        for upstream in self.candidates(client_ip):
+            target = self._take_idle(upstream)
+            if target is None:
+                try:
+                    target = await asyncio.wait_for(connect_socket(upstream.host, upstream.port), self.connect_timeout)
+                except (OSError, asyncio.TimeoutError) as e:
+                    error = e
+                    self._failed(upstream, e)
+                    continue
+            upstream.failures = 0
+            upstream.demand += 1
+            if self.warm:
+                self._refill(upstream)
+            if adopt is None:
+                result = target
+            else:
+                try:
+                    result = await adopt(target)
+                except BaseException:
+                    target.close()
+                    raise
+            upstream.active += 1
+            return upstream, result
+        raise error if isinstance(error, OSError) else OSError(f"连接{self}超时")
+
+    def _take_idle(self, upstream: Upstream) -> Optional[socket.socket]:
+        """取一个还活着的空闲连接，先用最新的，旧的留给idle_timeout清理"""
+        while upstream.idle:
+            target, _ = upstream.idle.pop()
+            if socket_alive(target):
+                return target
+            target.close()
+        return None
+
+    def _refill(self, upstream: Upstream):
+        """补充预热连接到desired个"""
+        if not upstream.available:
+            return
+        for _ in range(upstream.desired - len(upstream.idle) - upstream.pending):
+            upstream.pending += 1
+            task = asyncio.get_running_loop().create_task(self._warm_one(upstream))
+            self._warming.add(task)
+            task.add_done_callback(self._warming.discard)
+
+    async def _warm_one(self, upstream: Upstream):
+        try:
+            target = await asyncio.wait_for(connect_socket(upstream.host, upstream.port), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self._failed(upstream, e)
+            return
+        finally:
+            upstream.pending -= 1
+        target.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        upstream.idle.append((target, time.monotonic()))
+
+    async def _keep_warm(self):
+        """按新连接的速度调整每个目标的空闲连接数，关掉太久没用的"""
+        while True:
+            await asyncio.sleep(WARM_TICK)
+            now = time.monotonic()
+            for upstream in self.upstreams:
+                upstream.rate = upstream.rate * 0.7 + upstream.demand / WARM_TICK * 0.3
+                upstream.demand = 0
+                # 空闲连接要够下一次补充之前用，至少留一个
+                upstream.desired = max(1, min(self.warm, math.ceil(upstream.rate * WARM_TICK * 2)))
+                idle = upstream.idle
+                while idle and (now - idle[0][1] > self.idle_timeout or len(idle) > upstream.desired):
+                    idle.popleft()[0].close()
+                if not upstream.available:
+                    self._close_idle(upstream)
+                else:
+                    self._refill(upstream)
+
+    @staticmethod
+    def _close_idle(upstream: Upstream):
+        while upstream.idle:
+            upstream.idle.pop()[0].close()
+
+    @staticmethod
+    def release(upstream: Upstream):
+        upstream.active -= 1
+
+    def _failed(self, upstream: Upstream, error: Exception):
+        upstream.failures += 1
+        logging.warning("连接%s失败(%d次):%r", upstream, upstream.failures, error)
+        if upstream.failures >= self.max_fails and upstream.ejected_until <= time.monotonic():
+            upstream.ejected_until = time.monotonic() + self.eject_time
+            logging.warning("%s连续失败%d次，%.0f秒内不再使用", upstream, upstream.failures, self.eject_time)
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self.health_interval > 0 and len(self.upstreams) > 1 and self._health_task is None:
+            self._health_task = loop.create_task(self._health_check())
+        if self.warm > 0 and self._warm_task is None:
+            self._warm_task = loop.create_task(self._keep_warm())
+            for upstream in self.upstreams:
+                self._refill(upstream)
+
+    def close(self):
+        for task in (self._health_task, self._warm_task, *self._warming):
+            if task is not None:
+                task.cancel()
+        self._health_task = self._warm_task = None
+        for upstream in self.upstreams:
+            self._close_idle(upstream)
+
+    async def _health_check(self):
+        while True:
+            await asyncio.gather(*(self._check(u) for u in self.upstreams))
+            await asyncio.sleep(self.health_interval)
+
+    async def _check(self, upstream: Upstream):
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(upstream.host, upstream.port), self.health_timeout)
+        except (OSError, asyncio.TimeoutError):
+            if upstream.healthy:
+                logging.warning("%s健康检查失败", upstream)
+            upstream.healthy = False
+            return
+        writer.close()
+        if not upstream.healthy or upstream.ejected_until:
+            logging.info("%s恢复可用", upstream)
+        upstream.healthy = True
+        upstream.ejected_until = 0.0
+        upstream.failures = 0
+
+
+def socket_alive(sock: socket.socket) -> bool:
+    """
+    空闲的连接是否还能用，对方关闭了(FIN/RST)就不能用
+    有数据不代表关闭，比如先发欢迎信息的协议，数据会原样转发；Linux上直接看TCP状态，数据后面跟着FIN也能发现
+    """
+    if hasattr(socket, "TCP_INFO"):
+        try:
+            return sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 1)[0] == 1  # TCP_ESTABLISHED
+        except OSError:
+            return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK) != b""
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+
+
+async def handle_conn(pool: UpstreamPool, stats: Stats, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                      buffer_size: int = DEFAULT_BUFFER_SIZE):
+    task = asyncio.current_task()
+    _connections.add(task)
+    task.add_done_callback(_connections.discard)
+    accepted_at = time.monotonic()
+    peer = writer.get_extra_info('peername')
+    stats.accepted += 1
     # 连接目标地址
     try:
-        target_reader, target_writer = await asyncio.open_connection(target_ip, target_port)
-        logging.info(f"{conn_addr}已连接{target_ip}:{target_port}")
-    except ConnectionRefusedError as e:  # 连接出错时
-        logging.error(f"{conn_addr}连接{target_ip}:{target_port}被拒绝:{e}")
+        upstream, (target_reader, target_writer) = await pool.connect(
+            peer[0], lambda target: asyncio.open_connection(sock=target, limit=buffer_size))
+    except OSError as e:  # 连接出错时
+        stats.connect_errors += 1
+        logging.error("%s:%s连接%s失败:%s", peer[0], peer[1], pool, e)
+        writer.close()
         return
-    # 转发
+    stats.connect_time.observe(time.monotonic() - accepted_at)
+    stats.active += 1
+    logging.info("%s:%s已连接%s", peer[0], peer[1], upstream)
+    # 转发，一个方向结束后只关闭对面的写端，另一个方向还能继续传，直到两边都结束
     try:
-        await asyncio.gather(
-            forward(reader, target_writer),
-            forward(target_reader, writer)
+        sent, received = await both_directions(
+            forward(reader, target_writer, buffer_size, stats.traffic, IN),
+            forward(target_reader, writer, buffer_size, stats.traffic, OUT)
         )
-    except EOFError:  # 关闭连接时
-        logging.info(f"{conn_addr}已断开")
+        logging.info("%s:%s已断开，上传%d字节，下载%d字节", peer[0], peer[1], sent, received)
     except Exception as e:  # 转发出错时
-        import traceback
-        traceback.print_exc()
-        logging.error(f"{conn_addr}与{target_ip}:{target_port}通信异常:{e}")
+        stats.transfer_errors += 1
+        logging.error("%s:%s与%s通信异常:%r", peer[0], peer[1], upstream, e)
     finally:
+        stats.active -= 1
+        stats.duration.observe(time.monotonic() - accepted_at)
+        pool.release(upstream)
         target_writer.close()
         writer.close()
 
 
-async def forward(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+async def both_directions(upstream, downstream) -> list:
+    """两个方向都结束才返回各自的结果，其中一个出错时取消另一个，不然它可能一直等在已经关闭的连接上"""
+    tasks = [asyncio.ensure_future(upstream), asyncio.ensure_future(downstream)]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def forward(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                  traffic: Optional[list[int]] = None, direction: int = IN) -> int:
+    """转发一个方向，返回转发的字节数，同时累加到traffic[direction]"""
+    traffic = traffic if traffic is not None else [0, 0]
+    total = 0
     while True:
-        data = await reader.read(1024)
+        data = await reader.read(buffer_size)
         if not data:
+            if writer.can_write_eof():
+                writer.write_eof()
             await writer.drain()
-            raise EOFError
+            return total
         writer.write(data)
+        total += len(data)
+        traffic[direction] += len(data)
+        await writer.drain()  # 对面收得慢时在这里等，不会无限制地缓存
+
+
+async def connect_socket(host: str, port: int) -> socket.socket:
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    family, kind, proto, _, address = infos[0]
+    target = socket.socket(family, kind, proto)
+    target.setblocking(False)
+    try:
+        await loop.sock_connect(target, address)
+    except BaseException:
+        target.close()
+        raise
+    return target
+
+
+async def handle_socket(pool: UpstreamPool, stats: Stats, client: socket.socket, engine: str = "socket",
+                        buffer_size: int = DEFAULT_BUFFER_SIZE):
+    """socket和splice引擎，client是已经accept的非阻塞socket"""
+    accepted_at = time.monotonic()
+    peer = client.getpeername()
+    stats.accepted += 1
+    try:
+        upstream, target = await pool.connect(peer[0])
+    except OSError as e:
+        stats.connect_errors += 1
+        logging.error("%s:%s连接%s失败:%s", peer[0], peer[1], pool, e)
+        client.close()
+        return
+    stats.connect_time.observe(time.monotonic() - accepted_at)
+    stats.active += 1
+    logging.info("%s:%s已连接%s", peer[0], peer[1], upstream)
+    pipe = splice_socket if engine == "splice" else copy_socket
+    try:
+        for s in (client, target):
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sent, received = await both_directions(pipe(client, target, buffer_size, stats.traffic, IN),
+                                               pipe(target, client, buffer_size, stats.traffic, OUT))
+        logging.info("%s:%s已断开，上传%d字节，下载%d字节", peer[0], peer[1], sent, received)
+    except Exception as e:
+        stats.transfer_errors += 1
+        logging.error("%s:%s与%s通信异常:%r", peer[0], peer[1], upstream, e)
+    finally:
+        stats.active -= 1
+        stats.duration.observe(time.monotonic() - accepted_at)
+        pool.release(upstream)
+        target.close()
+        client.close()
+
+
+def _shutdown_write(s: socket.socket):
+    try:
+        s.shutdown(socket.SHUT_WR)
+    except OSError:  # 对面已经断开了
+        pass
+
+
+async def copy_socket(src: socket.socket, dst: socket.socket, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                      traffic: Optional[list[int]] = None, direction: int = IN) -> int:
+    """把src的数据转发到dst，缓冲区只分配一次，sendall完才会再收，所以不会多占内存；返回转发的字节数"""
+    loop = asyncio.get_running_loop()
+    traffic = traffic if traffic is not None else [0, 0]
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    total = 0
+    try:
+        while True:
+            n = await loop.sock_recv_into(src, buffer)
+            if not n:
+                return total
+            await loop.sock_sendall(dst, view[:n])
+            total += n
+            traffic[direction] += n
+    finally:
+        _shutdown_write(dst)
+
+
+async def _wait_fd(fd: int, writable: bool):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    add, remove = (loop.add_writer, loop.remove_writer) if writable else (loop.add_reader, loop.remove_reader)
+    add(fd, lambda: future.done() or future.set_result(None))
+    try:
+        await future
+    finally:
+        remove(fd)
+
+
+async def splice_socket(src: socket.socket, dst: socket.socket, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                        traffic: Optional[list[int]] = None, direction: int = IN) -> int:
+    """
+    用splice转发：src -> 管道 -> dst，数据只在内核中移动，返回转发的字节数
+    每次把管道里的数据全部写给dst之后才会再从src读，管道就是这个方向的缓冲区
+    """
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    traffic = traffic if traffic is not None else [0, 0]
+    total = 0
+    read_fd, write_fd = os.pipe()
+    try:
+        if hasattr(os, "set_blocking"):
+            os.set_blocking(read_fd, False)
+            os.set_blocking(write_fd, False)
+        try:
+            import fcntl
+            fcntl.fcntl(write_fd, getattr(fcntl, "F_SETPIPE_SZ", 1031), buffer_size)  # 管道默认只有64KB
+        except OSError:  # 超过/proc/sys/fs/pipe-max-size时保持默认大小
+            pass
+        while True:
+            try:
+                n = os.splice(src.fileno(), write_fd, buffer_size, flags=flags)
+            except BlockingIOError:
+                await _wait_fd(src.fileno(), False)
+                continue
+            if not n:
+                return total
+            total += n
+            traffic[direction] += n
+            while n:
+                try:
+                    n -= os.splice(read_fd, dst.fileno(), n, flags=flags)
+                except BlockingIOError:
+                    await _wait_fd(dst.fileno(), True)
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+        _shutdown_write(dst)
+
+
+class ReadBuffer:
+    """
+    protocol引擎所有连接共用的读缓冲区，收到的数据马上写给另一端，所以一个就够了
+    写不完时transport可能直接引用这块内存，这时换一块新的，旧的归transport
+    """
+    __slots__ = ("size", "view")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.renew()
+
+    def renew(self):
+        self.view = memoryview(bytearray(self.size))
+
+
+class ForwardProtocol(asyncio.BufferedProtocol):
+    """
+    连接的一端，收到的数据直接写给另一端(peer)的transport
+    另一端写不过来(pause_writing)时暂停这一端的读取，写完了(resume_writing)再继续
+    """
+    def __init__(self, buffer: ReadBuffer, stats: Stats, direction: int, peername: tuple = ("", 0)):
+        """
+        :param stats: 监听地址的统计
+        :param direction: 这一端收到的数据是哪个方向的流量
+        :param peername: 客户端的地址，只用于日志
+        """
+        self.buffer = buffer
+        self.stats = stats
+        self.direction = direction
+        self.peername = peername
+        self.received = 0  # 这一端收到(转发)的字节数
+        self.transport: Optional[asyncio.Transport] = None
+        self.peer: Optional["ForwardProtocol"] = None
+        self.eof = False
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.buffer.size)
+        if self.peer is None:  # 还没有另一端，先不读，link以后再开始
+            transport.pause_reading()
+
+    def link(self, peer: "ForwardProtocol"):
+        self.peer, peer.peer = peer, self
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.buffer.view
+
+    def buffer_updated(self, nbytes: int):
+        self.received += nbytes
+        self.stats.traffic[self.direction] += nbytes
+        transport = self.peer.transport
+        if transport.get_write_buffer_size():  # 前面还有没写完的，这次的数据只会进缓冲区，要复制一份
+            transport.write(bytes(self.buffer.view[:nbytes]))
+            return
+        transport.write(self.buffer.view[:nbytes])
+        if transport.get_write_buffer_size():  # 没有一次写完，剩下的部分可能引用着共用的缓冲区
+            self.buffer.renew()
+
+    def eof_received(self) -> bool:
+        self.eof = True
+        if self.peer.eof:  # 两个方向都结束了，close会等缓冲区写完
+            self.transport.close()
+            self.peer.transport.close()
+            return False
+        if self.peer.transport.can_write_eof():
+            self.peer.transport.write_eof()
+        return True  # 半关闭，另一个方向还能继续传
+
+    def pause_writing(self):
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if self.peer is not None:
+            if exc is None:
+                self.peer.transport.close()
+            else:
+                self.stats.transfer_errors += 1
+                logging.error("%s:%s通信异常:%r", self.peername[0], self.peername[1], exc)
+                self.peer.transport.abort()
+
+
+class ClientProtocol(ForwardProtocol):
+    """客户端那一端，等目标连接建立后两端再开始转发"""
+    def __init__(self, buffer: ReadBuffer, pool: UpstreamPool, stats: Stats):
+        super().__init__(buffer, stats, IN)
+        self.pool = pool
+        self.upstream: Optional[Upstream] = None
+        self.accepted_at = 0.0
+
+    def connection_made(self, transport: asyncio.Transport):
+        super().connection_made(transport)
+        self.accepted_at = time.monotonic()
+        self.peername = transport.get_extra_info("peername")
+        self.stats.accepted += 1
+        task = asyncio.get_running_loop().create_task(self.connect())
+        _connections.add(task)
+        task.add_done_callback(_connections.discard)
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        peername = self.peername
+        try:
+            self.upstream, (_, target) = await self.pool.connect(
+                peername[0],
+                lambda target: loop.create_connection(lambda: ForwardProtocol(self.buffer, self.stats, OUT, peername),
+                                                      sock=target))
+        except OSError as e:
+            self.stats.connect_errors += 1
+            logging.error("%s:%s连接%s失败:%s", peername[0], peername[1], self.pool, e)
+            self.transport.close()
+            return
+        if self.transport.is_closing():  # 连接目标的时候客户端已经断开了
+            target.transport.close()
+            self.pool.release(self.upstream)
+            self.upstream = None
+            return
+        self.stats.connect_time.observe(time.monotonic() - self.accepted_at)
+        self.stats.active += 1
+        logging.info("%s:%s已连接%s", peername[0], peername[1], self.upstream)
+        self.link(target)
+        self.transport.resume_reading()
+        target.transport.resume_reading()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        super().connection_lost(exc)
+        if self.upstream is not None:
+            self.stats.active -= 1
+            self.stats.duration.observe(time.monotonic() - self.accepted_at)
+            self.pool.release(self.upstream)
+            self.upstream = None
+            if exc is None:
+                logging.info("%s:%s已断开，上传%d字节，下载%d字节",
+                             self.peername[0], self.peername[1], self.received, self.peer.received)
+
+
+async def open_listener(bind_ip: str, bind_port: int, backlog: int = 1024, reuse_port: bool = False) -> socket.socket:
+    """socket和splice引擎用的监听socket，reuse_port时多个进程可以监听同一个端口，由内核分配连接"""
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(bind_ip, bind_port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)
+    family, kind, proto, _, address = infos[0]
+    listener = socket.socket(family, kind, proto)
+    try:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind(address)
+        listener.listen(backlog)
+        listener.setblocking(False)
+    except OSError:
+        listener.close()
+        raise
+    return listener
+
+
+async def accept_loop(listener: socket.socket, handler):
+    """accept循环，每个连接交给handler(client)处理；取消时只关闭监听socket，已建立的连接不受影响"""
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            client, _ = await loop.sock_accept(listener)
+            client.setblocking(False)
+            task = asyncio.create_task(handler(client))
+            _connections.add(task)
+            task.add_done_callback(_connections.discard)
+    finally:
+        listener.close()
+
+
+@dataclass(frozen=True)
+class Rule:
+    """一条转发规则"""
+    bind_ip: str
+    bind_port: int
+    targets: tuple[tuple[str, int], ...]  # 目标池，只有一个时就是普通的转发
+    engine: str = "stream"
+    buffer_size: int = DEFAULT_BUFFER_SIZE
+    balance: str = "round_robin"
+    health_interval: float = 5.0  # 健康检查的间隔秒数，0代表不检查
+    warm: int = 0  # 每个目标最多预热几个空闲连接，0代表不预热
+
+    @property
+    def listen(self) -> tuple[str, int]:
+        return self.bind_ip, self.bind_port
+
+    def __str__(self):
+        targets = ",".join(f"{host}:{port}" for host, port in self.targets)
+        if len(self.targets) > 1:
+            targets = f"[{targets}]({self.balance})"
+        return f"{self.bind_ip}:{self.bind_port} -> {targets}({self.engine})"
+
+
+def parse_address(text: str, default_host: str = "") -> tuple[str, int]:
+    """解析"host:port"、"[ipv6]:port"或者只有端口"""
+    text = str(text).strip()
+    host, _, port = text.rpartition(":")
+    host = host.strip("[]") or default_host
+    if not port.isdigit() or not 0 < int(port) < 65536 or not host:
+        raise ValueError(f"地址格式不对: {text}")
+    return host, int(port)
+
+
+def load_rules(path: str) -> list[Rule]:
+    """
+    从配置文件读取规则，支持toml和yaml(需要安装PyYAML)，格式如下(toml)：
+        [defaults]
+        engine = "protocol"
+        buffer_size = 262144
+
+        [[rules]]
+        listen = "0.0.0.0:8080"
+        target = "10.0.0.2:80"
+        engine = "splice"  # 可以省略，使用defaults里的
+
+        [[rules]]
+        listen = "0.0.0.0:8081"
+        targets = ["10.0.0.3:80", "10.0.0.4:80"]  # 多个目标，按balance选择
+        balance = "least_conn"
+        health_interval = 2
+        warm = 16  # 预热连接池
+    """
+    with open(path, "rb") as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+            config = yaml.safe_load(f) or {}
+        else:
+            try:
+                import tomllib
+            except ImportError:  # Python 3.10及以下
+                import tomli as tomllib
+            config = tomllib.load(f)
+    defaults = config.get("defaults", {})
+    rules = []
+    for item in config.get("rules", []):
+        item = {**defaults, **item}
+        bind_ip, bind_port = parse_address(item["listen"], "0.0.0.0")
+        targets = item.get("targets") or [item["target"]]
+        targets = tuple(parse_address(target) for target in ([targets] if isinstance(targets, str) else targets))
+        engine = item.get("engine", "stream")
+        if engine not in ENGINES:
+            raise ValueError(f"{item['listen']}: 引擎只能是{'/'.join(ENGINES)}")
+        balance = item.get("balance", "round_robin")
+        if balance not in BALANCES:
+            raise ValueError(f"{item['listen']}: 负载均衡策略只能是{'/'.join(BALANCES)}")
+        rules.append(Rule(bind_ip, bind_port, targets, engine, int(item.get("buffer_size", DEFAULT_BUFFER_SIZE)),
+                          balance, float(item.get("health_interval", 5.0)), int(item.get("warm", 0))))
+    listens = [rule.listen for rule in rules]
+    if len(set(listens)) != len(listens):
+        raise ValueError("有多条规则监听同一个地址")
+    return rules
+
+
+class Listener:
+    """
+    一个监听地址，新连接总是使用当前的目标池，所以只改目标时不用重新监听
+    停止时只关闭监听，已建立的连接会继续转发，直到自己断开
+    """
+    def __init__(self, rule: Rule, reuse_port: bool = False):
+        self.rule = rule
+        self.reuse_port = reuse_port
+        self.stats = get_stats(rule.bind_ip, rule.bind_port)
+        self.pool = self._create_pool(rule)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def can_update(self, rule: Rule) -> bool:
+        """引擎和缓冲区大小一样时可以直接替换规则"""
+        return (rule.listen, rule.engine, rule.buffer_size) == (self.rule.listen, self.rule.engine, self.rule.buffer_size)
+
+    def update(self, rule: Rule):
+        """替换规则，目标池变了就换一个新的，旧池子里正在转发的连接不受影响"""
+        old, self.rule = self.rule, rule
+        if (old.targets, old.balance, old.health_interval, old.warm) != \
+                (rule.targets, rule.balance, rule.health_interval, rule.warm):
+            self.pool.close()
+            self.pool = self._create_pool(rule)
+            self.pool.start()
+
+    @staticmethod
+    def _create_pool(rule: Rule) -> UpstreamPool:
+        return UpstreamPool(rule.targets, rule.balance, health_interval=rule.health_interval, warm=rule.warm)
+
+    async def start(self):
+        rule = self.rule
+        loop = asyncio.get_running_loop()
+        if rule.engine == "stream":
+            def handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+                return handle_conn(self.pool, self.stats, reader, writer, rule.buffer_size)
+            self._server = await asyncio.start_server(handler, rule.bind_ip, rule.bind_port, limit=rule.buffer_size,
+                                                      backlog=1024, reuse_port=self.reuse_port or None)
+        elif rule.engine == "protocol":
+            buffer = ReadBuffer(rule.buffer_size)
+            self._server = await loop.create_server(lambda: ClientProtocol(buffer, self.pool, self.stats),
+                                                    rule.bind_ip, rule.bind_port, backlog=1024,
+                                                    reuse_port=self.reuse_port or None)
+        else:
+            engine = rule.engine
+            if engine == "splice" and not hasattr(os, "splice"):
+                logging.warning("当前系统不支持splice，改用socket引擎")
+                engine = "socket"
+
+            def handler(client: socket.socket):
+                return handle_socket(self.pool, self.stats, client, engine, rule.buffer_size)
+            self._task = asyncio.create_task(accept_loop(
+                await open_listener(rule.bind_ip, rule.bind_port, reuse_port=self.reuse_port), handler))
+        self.pool.start()
+        logging.info("开始监听 %s", rule)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()  # 不等wait_closed，它会等所有连接断开
+        if self._task is not None:
+            self._task.cancel()
+        self.pool.close()
+        logging.info("停止监听 %s", self.rule)
+
+
+class Forwarder:
+    """在一个事件循环中运行多条规则，apply可以反复调用，只改动有变化的监听"""
+    def __init__(self, reuse_port: bool = False):
+        self.listeners: dict[tuple[str, int], Listener] = {}
+        self.reuse_port = reuse_port
+
+    async def apply(self, rules: list[Rule]):
+        new = {rule.listen: rule for rule in rules}
+        for listen in list(self.listeners):
+            if listen not in new:
+                self.listeners.pop(listen).stop()
+        for listen, rule in new.items():
+            listener = self.listeners.get(listen)
+            if listener is not None:
+                if listener.rule == rule:
+                    continue
+                if listener.can_update(rule):
+                    logging.info("更新规则 %s => %s", listener.rule, rule)
+                    listener.update(rule)
+                    continue
+                self.listeners.pop(listen).stop()  # 引擎或缓冲区大小变了，要重新监听
+            listener = Listener(rule, self.reuse_port)
+            try:
+                await listener.start()
+            except OSError as e:
+                logging.error("监听%s失败:%s", rule, e)
+                continue
+            self.listeners[listen] = listener
+
+    def close(self):
+        for listener in self.listeners.values():
+            listener.stop()
+        self.listeners.clear()
+
+
+async def serve(bind_ip: str, bind_port: int, target_ip: str, target_port: int, engine: str = "stream",
+                buffer_size: int = DEFAULT_BUFFER_SIZE, upstreams: tuple[tuple[str, int], ...] = (),
+                balance: str = "round_robin", warm: int = 0):
+    """只有一条规则时的简单写法，upstreams是除了target以外的其他目标"""
+    targets = ((target_ip, target_port),) + tuple(upstreams)
+    await serve_rules([Rule(bind_ip, bind_port, targets, engine, buffer_size, balance, warm=warm)])
+
+
+async def serve_rules(rules: list[Rule], reuse_port: bool = False):
+    """运行固定的几条规则，一条都监听不了时抛出OSError"""
+    forwarder = Forwarder(reuse_port)
+    await forwarder.apply(rules)
+    if not forwarder.listeners:
+        raise OSError(f"无法监听{', '.join(str(rule) for rule in rules)}")
+    try:
+        await asyncio.get_running_loop().create_future()  # 一直运行，直到被取消
+    finally:
+        forwarder.close()
+
+
+async def serve_config(path: str, extra_rules: Optional[list[Rule]] = None, reuse_port: bool = False):
+    """按配置文件运行，收到SIGHUP时重新读取配置，只改动有变化的规则，已建立的连接不受影响"""
+    loop = asyncio.get_running_loop()
+    forwarder = Forwarder(reuse_port)
+    extra_rules = extra_rules or []
+    await forwarder.apply(load_rules(path) + extra_rules)
+
+    async def reload():
+        try:
+            rules = load_rules(path) + extra_rules
+        except Exception as e:  # 配置写错了就继续用原来的
+            logging.error("重新读取配置%s失败:%r", path, e)
+            return
+        logging.info("重新读取配置%s", path)
+        await forwarder.apply(rules)
+
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(signal.SIGHUP, lambda: loop.create_task(reload()))
+    else:
+        logging.warning("当前系统没有SIGHUP，不支持重新读取配置")
+    try:
+        await loop.create_future()
+    finally:
+        forwarder.close()
+
+
+async def worker(rules: list[Rule], config: Optional[str], conn):
+    """
+    多进程模式的工作进程，和其他工作进程监听同样的端口(SO_REUSEPORT)，定时通过conn上报统计
+    第一次上报在运行了一个间隔之后，监听失败时不会上报，主进程据此判断启动失败
+    """
+    parent = os.getppid()
+    serving = asyncio.create_task(serve_config(config, rules, True) if config else serve_rules(rules, True))
+    try:
+        while True:
+            await asyncio.wait([serving], timeout=STATS_INTERVAL)
+            if serving.done():
+                break
+            try:
+                conn.send({listen: stats.snapshot() for listen, stats in listener_stats.items()})
+            except OSError:
+                pass
+            if os.getppid() != parent:  # 主进程被强制结束了，工作进程也退出
+                logging.warning("主进程已退出")
+                break
+    finally:
+        if not serving.done():
+            serving.cancel()
+            await asyncio.wait([serving])
+    if not serving.cancelled():
+        serving.result()  # 监听失败时抛出异常
+
+
+def run_worker(rules: list[Rule], config: Optional[str], conn, use_uvloop: bool = False):
+    # fork出来的进程继承了主进程事件循环的信号处理，要恢复默认，否则terminate结束不了
+    signal.set_wakeup_fd(-1)
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C由主进程处理，它会结束所有工作进程
+    raise_nofile_limit()
+    run(worker(rules, config, conn), use_uvloop)
+
+
+class WorkerError(Exception):
+    """工作进程启动失败"""
+
+
+class Supervisor:
+    """多进程模式的主进程，启动工作进程，退出的重新启动，汇总所有工作进程的统计"""
+    def __init__(self, rules: list[Rule], config: Optional[str], workers: int, use_uvloop: bool = False,
+                 log_interval: float = 10.0, stats_address: Optional[tuple[str, int]] = None):
+        """
+        :param rules: 命令行指定的规则
+        :param config: 配置文件，收到SIGHUP时转发给所有工作进程，让它们各自重新读取
+        :param workers: 工作进程数
+        :param log_interval: 每隔多少秒打印一次汇总的统计
+        :param stats_address: 统计接口的地址，由主进程提供汇总后的统计
+        """
+        self.rules = rules
+        self.config = config
+        self.use_uvloop = use_uvloop
+        self.log_interval = log_interval
+        self.stats_address = stats_address
+        self.processes: list[Optional[multiprocessing.Process]] = [None] * workers
+        self.pipes: list = [None] * workers
+        self.latest: list[dict[str, dict]] = [{} for _ in range(workers)]  # 每个工作进程最后一次上报的统计
+        self.reported = [False] * workers  # 工作进程是否上报过统计，还没上报就退出说明启动失败
+        self.retired: dict[str, Stats] = {}  # 已经退出的工作进程的累计值
+
+    def spawn(self, index: int):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=run_worker, args=(self.rules, self.config, sender, self.use_uvloop),
+                                          name=f"worker-{index}", daemon=True)
+        process.start()
+        sender.close()
+        self.processes[index], self.pipes[index] = process, receiver
+        self.reported[index] = False
+
+    def collect(self, index: int):
+        """读取工作进程上报的统计，只保留最新的"""
+        pipe = self.pipes[index]
+        try:
+            while pipe.poll():
+                self.latest[index] = pipe.recv()
+                self.reported[index] = True
+        except (EOFError, OSError):  # 工作进程已经退出
+            pass
+
+    def total(self) -> dict[str, Stats]:
+        """按监听地址汇总所有工作进程的统计"""
+        total: dict[str, Stats] = {}
+        for listen, stats in self.retired.items():
+            total.setdefault(listen, Stats()).merge(stats.snapshot())
+        for latest in self.latest:
+            for listen, snapshot in latest.items():
+                total.setdefault(listen, Stats()).merge(snapshot)
+        return total
+
+    def check(self):
+        """
+        收集统计，重新启动已经退出的工作进程
+        还没上报过统计就退出的说明启动失败(比如端口被占用)，重新启动也没用，抛出WorkerError
+        """
+        for index, process in enumerate(self.processes):
+            self.collect(index)
+            if process.is_alive():
+                continue
+            if not self.reported[index]:
+                raise WorkerError(f"工作进程{index}(pid {process.pid})启动失败，退出码{process.exitcode}")
+            logging.warning("工作进程%d(pid %d)退出了，退出码%s，重新启动", index, process.pid, process.exitcode)
+            for listen, snapshot in self.latest[index].items():
+                self.retired.setdefault(listen, Stats()).merge(snapshot, gauges=False)
+            self.latest[index] = {}
+            self.pipes[index].close()
+            self.spawn(index)
+
+    def reload(self):
+        logging.info("通知工作进程重新读取配置")
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stopping = loop.create_future()
+        if self.config is not None:
+            loop.add_signal_handler(signal.SIGHUP, self.reload)
+        loop.add_signal_handler(signal.SIGTERM, lambda: stopping.done() or stopping.set_result(None))
+        for index in range(len(self.processes)):
+            self.spawn(index)
+        logging.info("启动了%d个工作进程", len(self.processes))
+        stats_server = await serve_stats(*self.stats_address, self.total) if self.stats_address else None
+        last_log, last_total = loop.time(), None
+        try:
+            while not stopping.done():
+                await asyncio.wait([stopping], timeout=STATS_INTERVAL)
+                self.check()
+                if loop.time() - last_log >= self.log_interval:
+                    total = Stats()
+                    for stats in self.total().values():
+                        total.merge(stats.snapshot())
+                    if total.snapshot() != last_total:
+                        logging.info("%d个工作进程: %s", len(self.processes), total)
+                    last_log, last_total = loop.time(), total.snapshot()
+        finally:
+            if stats_server is not None:
+                stats_server.close()
+            for process in self.processes:
+                if process is not None:
+                    process.terminate()
+            for process in self.processes:
+                if process is not None:
+                    process.join()
 
 
 async def main(
-    bind_port: int = typer.Argument(min=1, max=65535),
-    target_ip: str = typer.Argument(metavar="IP"),
-    target_port: int = typer.Argument(min=1, max=65535),
-    bind_ip: str = typer.Option("0.0.0.0", metavar="IP")
+    bind_port: Optional[int] = typer.Argument(None, min=1, max=65535),
+    target_ip: Optional[str] = typer.Argument(None, metavar="IP"),
+    target_port: Optional[int] = typer.Argument(None, min=1, max=65535),
+    bind_ip: str = typer.Option("0.0.0.0", metavar="IP"),
+    engine: str = typer.Option("stream", help="转发引擎: " + "/".join(ENGINES)),
+    buffer_size: int = typer.Option(DEFAULT_BUFFER_SIZE, min=4096, help="每个方向的缓冲区大小"),
+    upstream: list[str] = typer.Option([], metavar="HOST:PORT", help="更多的目标，可以指定多次，和IP:TARGET_PORT组成目标池"),
+    balance: str = typer.Option("round_robin", help="多个目标时的负载均衡策略: " + "/".join(BALANCES)),
+    warm: int = typer.Option(0, min=0, help="每个目标最多预热几个空闲连接，按新连接的速度自动调整，0代表不预热"),
+    uvloop: bool = typer.Option(False, help="使用uvloop事件循环，需要安装uvloop，不支持Windows"),
+    workers: int = typer.Option(1, min=1, help="工作进程数，大于1时每个进程都监听同样的端口(SO_REUSEPORT)，由内核分配连接"),
+    config: Optional[str] = typer.Option(None, help="规则配置文件(toml/yaml)，可以有多条规则，收到SIGHUP时重新读取"),
+    stats: Optional[str] = typer.Option(None, metavar="[HOST:]PORT",
+                                        help="统计接口的地址，GET /metrics返回Prometheus文本格式，HOST默认127.0.0.1")
 ):
-    """端口转发程序"""
-    handler = partial(handle_conn, target_ip, target_port)
-    async with await asyncio.start_server(handler, bind_ip, bind_port) as server:
-        logging.info(f"开始监听 {bind_ip}:{bind_port}")
-        await server.serve_forever()
+    """端口转发程序，可以在命令行指定一条规则，也可以用--config从配置文件读取多条规则"""
+    if engine not in ENGINES:
+        raise typer.BadParameter(f"引擎只能是{'/'.join(ENGINES)}", param_hint="--engine")
+    if balance not in BALANCES:
+        raise typer.BadParameter(f"负载均衡策略只能是{'/'.join(BALANCES)}", param_hint="--balance")
+    try:
+        upstreams = tuple(parse_address(text) for text in upstream)
+    except ValueError as e:
+        raise typer.BadParameter(str(e), param_hint="--upstream")
+    try:
+        stats_address = parse_address(stats, "127.0.0.1") if stats else None
+    except ValueError as e:
+        raise typer.BadParameter(str(e), param_hint="--stats")
+    rules = []
+    if bind_port is not None:
+        if target_ip is None or target_port is None:
+            raise typer.BadParameter("需要同时指定BIND_PORT、IP和TARGET_PORT")
+        rules.append(Rule(bind_ip, bind_port, ((target_ip, target_port),) + upstreams, engine, buffer_size, balance,
+                          warm=warm))
+    elif config is None:
+        raise typer.BadParameter("需要指定一条规则或者--config")
+    if workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        raise typer.BadParameter("当前系统不支持SO_REUSEPORT", param_hint="--workers")
+    raise_nofile_limit()
+    if workers > 1:
+        try:
+            await Supervisor(rules, config, workers, uvloop, stats_address=stats_address).run()
+        except WorkerError as e:
+            logging.error("%s", e)
+            raise typer.Exit(1)
+        return
+    stats_server = await serve_stats(*stats_address, lambda: listener_stats) if stats_address else None
+    try:
+        if config is not None:
+            await serve_config(config, rules)
+        else:
+            await serve(bind_ip, bind_port, target_ip, target_port, engine, buffer_size, upstreams, balance, warm)
+    finally:
+        if stats_server is not None:
+            stats_server.close()
+
+
+def raise_nofile_limit():
+    """把能打开的文件数提高到上限，每个转发的连接占两个"""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def run(coro, use_uvloop: bool = False):
+    if use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            logging.warning("没有安装uvloop，使用默认的事件循环")
+        else:
+            if hasattr(uvloop, "run"):
+                return uvloop.run(coro)
+            uvloop.install()  # 旧版本的uvloop
+    return asyncio.run(coro)
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
     from functools import wraps
     # 方法包装，让typer能够运行协程，这种写法比较神奇，推荐只在个人项目中使用
-    typer.run(wraps(main)(lambda *args, **kwargs: asyncio.run(main(*args, **kwargs))))
+    typer.run(wraps(main)(lambda *args, **kwargs: run(main(*args, **kwargs), kwargs.get("uvloop", False))))
@@ -0,0 +1,133 @@
+"""
+端口转发的吞吐量测试，在本机回环上比较各个转发引擎
+数据源每个连接发送size字节后关闭，客户端通过转发程序接收，统计总时间
+python 端口转发基准测试.py --size 1073741824 --connections 1 --connections 8
+"""
+import asyncio
+import logging
+import multiprocessing
+import socket
+import time
+
+import typer
+
+import 端口转发
+
+SOURCE_PORT = 19000
+FORWARD_PORT = 19001
+
+
+async def source(port: int, size: int):
+    """数据源，每个连接发送size字节，数据在一开始准备好，发送本身几乎不占CPU"""
+    block = memoryview(bytes(4 * 1024 * 1024))
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        remaining = size
+        try:
+            while remaining:
+                n = min(remaining, len(block))
+                writer.write(block[:n])
+                await writer.drain()
+                remaining -= n
+        except ConnectionError:  # wait_port探测端口时的连接
+            pass
+        finally:
+            writer.close()
+
+    async with await asyncio.start_server(handle, "127.0.0.1", port) as server:
+        await server.serve_forever()
+
+
+def run_source(port: int, size: int):
+    asyncio.run(source(port, size))
+
+
+def run_forwarder(port: int, target_port: int, engine: str, buffer_size: int, use_uvloop: bool, workers: int = 1):
+    logging.disable(logging.ERROR)  # wait_port探测端口时转发程序会记录连接出错
+    端口转发.raise_nofile_limit()
+    if workers > 1:
+        rule = 端口转发.Rule("127.0.0.1", port, (("127.0.0.1", target_port),), engine, buffer_size)
+        端口转发.run(端口转发.Supervisor([rule], None, workers, use_uvloop).run())
+    else:
+        端口转发.run(端口转发.serve("127.0.0.1", port, "127.0.0.1", target_port, engine, buffer_size), use_uvloop)
+
+
+def wait_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+async def receive(port: int) -> int:
+    loop = asyncio.get_running_loop()
+    sock = socket.socket()
+    sock.setblocking(False)
+    await loop.sock_connect(sock, ("127.0.0.1", port))
+    buffer = bytearray(1024 * 1024)
+    total = 0
+    try:
+        while True:
+            n = await loop.sock_recv_into(sock, buffer)
+            if not n:
+                return total
+            total += n
+    finally:
+        sock.close()
+
+
+async def measure(port: int, connections: int) -> tuple[float, int]:
+    start = time.perf_counter()
+    sizes = await asyncio.gather(*(receive(port) for _ in range(connections)))
+    return time.perf_counter() - start, sum(sizes)
+
+
+def main(
+    size: int = typer.Option(512 * 1024 * 1024, help="每个连接传输的字节数"),
+    connections: list[int] = typer.Option([1, 8], help="同时传输的连接数，可以指定多次"),
+    engines: list[str] = typer.Option(list(端口转发.ENGINES), "--engine", help="要测试的引擎，可以指定多次"),
+    buffer_size: int = typer.Option(端口转发.DEFAULT_BUFFER_SIZE, help="转发的缓冲区大小"),
+    rounds: int = typer.Option(3, min=1, help="每项测试几次，取最快的"),
+    uvloop: bool = typer.Option(False, help="转发程序使用uvloop"),
+    workers: int = typer.Option(1, min=1, help="转发程序的工作进程数"),
+):
+    """比较各个转发引擎在本机回环上的吞吐量，"直连"是不经过转发的上限"""
+    端口转发.raise_nofile_limit()
+    server = multiprocessing.Process(target=run_source, args=(SOURCE_PORT, size), daemon=True)
+    server.start()
+    try:
+        wait_port(SOURCE_PORT)
+        for engine in ["直连"] + engines:
+            if engine == "直连":
+                port, forwarder = SOURCE_PORT, None
+            else:
+                port = FORWARD_PORT
+                # 多进程模式要启动子进程，不能是daemon进程，在finally中结束
+                forwarder = multiprocessing.Process(target=run_forwarder,
+                                                    args=(port, SOURCE_PORT, engine, buffer_size, uvloop, workers))
+                forwarder.start()
+                wait_port(port)
+            try:
+                for count in connections:
+                    results = [asyncio.run(measure(port, count)) for _ in range(rounds)]
+                    elapsed = min(r[0] for r in results)
+                    total = results[0][1]
+                    if total != size * count:
+                        raise RuntimeError(f"{engine}: 收到{total}字节，应该是{size * count}")
+                    print(f"{engine:>8} {count:>3}个连接: {elapsed:.2f}s, {total / elapsed / 1024 / 1024:.0f}MB/s", flush=True)
+            finally:
+                if forwarder is not None:
+                    forwarder.terminate()
+                    forwarder.join()
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == "__main__":
+    typer.run(main)